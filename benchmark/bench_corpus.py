@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+曲库基准：用 midi/ 目录下的全部乐曲跑一遍演奏引擎
+
+每首曲子分别测量解析、分析（调式和基准音检测）、映射（生成查找表并预编译）的耗时，
+再用 NullBackend 跑完整的演奏循环，统计每秒处理的事件数和调度延迟的 p50 / p99 / 最大值。
+
+默认使用模拟时钟：调度器粗睡眠时直接把时钟拨到截止时间，不真正等待，
+延迟只包含引擎自身的处理开销，几秒内就能跑完整个曲库；
+加 --realtime 使用真实时钟（每首只演奏前 --max-seconds 秒），测量系统定时器带来的延迟。
+
+结果保存为 JSON，指定 --baseline 时与之前保存的结果逐项对比，变差超过 --threshold 时返回 1；
+基线的时钟、管线、乐器、帧率、编排限制或是否使用 numpy 与本次不同时不做对比，返回 2。
+加 --check-limits 时检查实际发出的按下是否超过 --max-keys / --max-keys-per-second
+（先用一首黑键同时演奏上下两个半音的合成乐曲检查，再检查曲库中的每一首），超过时返回 1。
+
+用法：python benchmark/bench_corpus.py [-o 结果.json] [--baseline 基线.json] [--realtime]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mido  # noqa: E402
+
+from 疯物之诗琴 import (INSTRUMENTS, ArrangementReport, DeadlineScheduler, FrameQuantizer,  # noqa: E402
+                   NoteLimiter, NullBackend, PlaybackConfig, PlaybackSession, analyze_song, build_note_table,
+                   compile_song, use_numpy)
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "midi")
+
+# 指标名 -> 是否越大越好，用于和基线对比
+SUMMARY_METRICS = {
+    "parse_ms": False,
+    "analysis_ms": False,
+    "mapping_ms": False,
+    "events_per_second": True,
+    "lateness_p50_us": False,
+    "lateness_p99_us": False,
+    "lateness_max_us": False,
+}
+
+
+class SimulatedClock:
+    """真实时钟加上一个偏移量，跳过的等待时间累加到偏移量里"""
+
+    def __init__(self):
+        self.offset = 0.0
+
+    def __call__(self):
+        return time.perf_counter() + self.offset
+
+
+class SimulatedStopEvent:
+    """代替调度器的 stop_event：wait(timeout) 不睡眠，而是把模拟时钟向前拨"""
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def wait(self, timeout=None):
+        if timeout:
+            self.clock.offset += timeout
+        return False
+
+    def is_set(self):
+        return False
+
+
+def percentile(ordered, q):
+    """已排序序列的 q 分位数（与 DeadlineScheduler.report 的算法相同）"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def limit_violations(batches, max_keys, max_keys_per_second):
+    """统计实际发出的按下中，同一时刻超过 max_keys、任意一秒内超过 max_keys_per_second 的次数"""
+    presses = []
+    violations = 0
+    for event_time, vks, downs, first, stop in batches:
+        count = sum(1 for i in range(first, stop) if downs[i])
+        if max_keys and count > max_keys:
+            violations += 1
+        presses.extend([event_time] * count)
+    if max_keys_per_second:
+        window_start = 0
+        for i, press_time in enumerate(presses):
+            while press_time - presses[window_start] >= 1.0:
+                window_start += 1
+            if i - window_start + 1 > max_keys_per_second:
+                violations += 1
+    return violations
+
+
+def double_key_song():
+    """合成乐曲：每 1/8 秒一个由相邻两个黑键组成的和弦（如 C# 与 D#），两个音各按两个键、共用中间的白键"""
+    midi = mido.MidiFile()  # 默认 480 tick/拍、120 BPM，一秒 960 tick
+    track = mido.MidiTrack()
+    midi.tracks.append(track)
+    pairs = [(octave + low, octave + low + 2) for octave in (48, 60, 72) for low in (1, 6, 8)]
+    for step in range(64):
+        chord = pairs[step % len(pairs)]
+        for note in chord:
+            track.append(mido.Message("note_on", note=note, velocity=80, time=0))
+        for offset, note in enumerate(chord):
+            track.append(mido.Message("note_off", note=note, time=0 if offset else 120))
+    return midi
+
+
+def check_double_keys(limiter):
+    """黑键全部按“同时演奏上下两个半音”映射，检查按下次数没有超过限制"""
+    note_table = build_note_table(INSTRUMENTS[0], 4, "C", 2, 2, (3, 3, 3))
+    assert any(len(keys) == 2 for keys in note_table), "查找表中没有双键映射"
+    song = compile_song(double_key_song(), note_table, None, limiter)
+    return limit_violations(song.batches(), limiter.max_keys_per_instant, limiter.max_keys_per_second)
+
+
+def play(batches, session, realtime, max_seconds):
+    """跑一遍演奏循环，返回 (事件数, 发送次数, 循环耗时秒, 调度器)"""
+    if realtime:
+        scheduler = DeadlineScheduler(threading.Event(), session.config.spin_window)
+    else:
+        clock = SimulatedClock()
+        scheduler = DeadlineScheduler(SimulatedStopEvent(clock), 0.0, clock)
+    send = session.send
+    events = 0
+    batches_sent = 0
+    start = time.perf_counter()
+    scheduler.start()
+    for event_time, vks, downs, first, stop in batches:
+        if event_time > max_seconds:
+            break
+        scheduler.wait_until(event_time)
+        send(vks, downs, first, stop)
+        events += stop - first
+        batches_sent += 1
+    session.release_all()
+    return events, batches_sent, time.perf_counter() - start, scheduler
+
+
+def bench_song(path, session, args):
+    midi, parse_ms = timed(mido.MidiFile, path)
+    analysis, analysis_ms = timed(analyze_song, midi)
+
+    build_start = time.perf_counter()
+    note_table = build_note_table(session.instrument, analysis.base_note, analysis.detected_key)
+    quantizer = session.config.quantizer
+    limiter = session.config.limiter
+    song = compile_song(midi, note_table, quantizer, limiter)
+    mapping_ms = (time.perf_counter() - build_start) * 1000
+    batches = song.batches()
+    report = song.arrangement or ArrangementReport()
+
+    violations = 0
+    if args.check_limits and limiter is not None:
+        # 帧对齐会把相邻时刻合并到同一帧，这时只检查每秒按键数
+        violations = limit_violations(song.batches(), 0 if quantizer else limiter.max_keys_per_instant,
+                                      limiter.max_keys_per_second)
+
+    events, batches_sent, elapsed, scheduler = play(batches, session, args.realtime, args.max_seconds)
+    lateness = scheduler.lateness()
+    ordered = sorted(lateness)
+    return {
+        "file": os.path.basename(path),
+        "parse_ms": parse_ms,
+        "analysis_ms": analysis_ms,
+        "mapping_ms": mapping_ms,
+        "events": events,
+        "batches": batches_sent,
+        "removed_notes": report.removed,
+        "limit_violations": violations,
+        "play_seconds": elapsed,
+        "events_per_second": events / elapsed if elapsed > 0 else 0.0,
+        "lateness_p50_us": percentile(ordered, 0.5) * 1e6,
+        "lateness_p99_us": percentile(ordered, 0.99) * 1e6,
+        "lateness_max_us": scheduler.late_max * 1e6,
+    }, lateness
+
+
+def best_of(runs):
+    """多次重复时每项耗时取最小值，吞吐取最大值"""
+    best = dict(runs[0])
+    for run in runs[1:]:
+        for key, higher_is_better in SUMMARY_METRICS.items():
+            best[key] = max(best[key], run[key]) if higher_is_better else min(best[key], run[key])
+    return best
+
+
+def summarize(songs, all_lateness):
+    ordered = sorted(all_lateness)
+    events = sum(song["events"] for song in songs)
+    play_seconds = sum(song["play_seconds"] for song in songs)
+    return {
+        "songs": len(songs),
+        "events": events,
+        "batches": sum(song["batches"] for song in songs),
+        "removed_notes": sum(song["removed_notes"] for song in songs),
+        "limit_violations": sum(song["limit_violations"] for song in songs),
+        "parse_ms": sum(song["parse_ms"] for song in songs),
+        "analysis_ms": sum(song["analysis_ms"] for song in songs),
+        "mapping_ms": sum(song["mapping_ms"] for song in songs),
+        "events_per_second": events / play_seconds if play_seconds > 0 else 0.0,
+        "lateness_p50_us": percentile(ordered, 0.5) * 1e6,
+        "lateness_p99_us": percentile(ordered, 0.99) * 1e6,
+        "lateness_max_us": max((song["lateness_max_us"] for song in songs), default=0.0),
+    }
+
+
+# 影响结果的运行设置 -> 旧版本基线中没有该项时的默认值
+COMPARABLE_SETTINGS = {
+    "clock": "simulated",
+    "pipeline": "compiled",
+    "instrument": 0,
+    "fps": 0,
+    "max_keys": 0,
+    "max_keys_per_second": 0,
+    "numpy": False,
+}
+
+
+def mismatched_settings(baseline_meta, meta):
+    """返回基线与本次不同的运行设置（“名称 基线值 -> 本次值”），设置不同时结果没有可比性"""
+    mismatched = []
+    for key, default in COMPARABLE_SETTINGS.items():
+        old = baseline_meta.get(key, default)
+        if old != meta[key]:
+            mismatched.append(f"{key} {old} -> {meta[key]}")
+    return mismatched
+
+
+def compare(summary, baseline, threshold):
+    """打印与基线的对比，返回变差超过阈值的指标"""
+    regressions = []
+    print(f"\n{'指标':<20}{'基线':>14}{'本次':>14}{'变化':>10}")
+    for key, higher_is_better in SUMMARY_METRICS.items():
+        old = baseline.get(key)
+        new = summary[key]
+        if not old:
+            print(f"{key:<20}{'-':>14}{new:>14.2f}{'-':>10}")
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > threshold:
+            regressions.append(key)
+            mark = "  ← 变差"
+        print(f"{key:<20}{old:>14.2f}{new:>14.2f}{change:>+9.1f}%{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="曲库基准")
+    parser.add_argument("--midi-dir", default=MIDI_DIR, help="乐曲目录（默认为仓库中的 midi/）")
+    parser.add_argument("-o", "--output", default="bench_corpus.json", help="结果 JSON 的保存路径")
+    parser.add_argument("--baseline", help="与之对比的基线结果 JSON")
+    parser.add_argument("--threshold", type=float, default=10.0, help="判定为变差的百分比")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="每首重复次数，取最好成绩")
+    parser.add_argument("--instrument", type=int, default=0, choices=(0, 1), help="0 诗琴，1 钢琴")
+    parser.add_argument("--realtime", action="store_true", help="使用真实时钟（真正等待）")
+    parser.add_argument("--fps", type=int, default=0, help="按游戏帧对齐事件的帧率，0 为不对齐")
+    parser.add_argument("--max-keys", type=int, default=0, help="同一时刻最多按键数，0 为不限制")
+    parser.add_argument("--max-keys-per-second", type=int, default=0, help="每秒最多按键数，0 为不限制")
+    parser.add_argument("--numpy", action="store_true", help="用 numpy 计算乐曲分析（需另行安装 numpy）")
+    parser.add_argument("--check-limits", action="store_true", help="检查实际发出的按下是否超过编排限制")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="每首最多演奏的秒数（--realtime 时默认 5 秒）")
+    args = parser.parse_args()
+    if args.max_seconds is None:
+        args.max_seconds = 5.0 if args.realtime else float("inf")
+
+    if args.numpy:
+        use_numpy()
+    quantizer = FrameQuantizer(args.fps, 1, 1) if args.fps > 0 else None
+    limiter = None
+    if args.max_keys or args.max_keys_per_second:
+        limiter = NoteLimiter(args.max_keys, args.max_keys_per_second, True, True, ())
+    config = PlaybackConfig(1, -1, 2, 2, (0, 3, 3), 0.002, 0.05, False, quantizer, limiter)
+    session = PlaybackSession(NullBackend(), INSTRUMENTS[args.instrument], config)
+    if args.check_limits:
+        if limiter is None:
+            parser.error("--check-limits 需要同时指定 --max-keys 或 --max-keys-per-second")
+        violations = check_double_keys(limiter)
+        print(f"双键映射合成乐曲：超出限制 {violations} 次")
+        if violations:
+            return 1
+
+    names = sorted(name for name in os.listdir(args.midi_dir) if name.lower().endswith((".mid", ".midi")))
+    songs = []
+    all_lateness = []
+    for name in names:
+        path = os.path.join(args.midi_dir, name)
+        runs = []
+        for _ in range(max(1, args.repeat)):
+            result, lateness = bench_song(path, session, args)
+            runs.append(result)
+        all_lateness.extend(lateness)
+        songs.append(best_of(runs))
+        song = songs[-1]
+        print(f"{name[:40]:<40} 解析 {song['parse_ms']:7.2f}ms  分析 {song['analysis_ms']:6.2f}ms  "
+              f"映射 {song['mapping_ms']:6.2f}ms  {song['events']:6d} 事件  "
+              f"p99 {song['lateness_p99_us']:8.1f}us")
+        if song["limit_violations"]:
+            print(f"  超出编排限制 {song['limit_violations']} 次")
+
+    summary = summarize(songs, all_lateness)
+    print(f"\n共 {summary['songs']} 首，{summary['events']} 个事件（{summary['batches']} 次发送，"
+          f"编排删去 {summary['removed_notes']} 个音符）：解析 {summary['parse_ms']:.1f}ms，"
+          f"分析 {summary['analysis_ms']:.1f}ms，映射 {summary['mapping_ms']:.1f}ms，"
+          f"{summary['events_per_second']:.0f} 事件/秒，调度延迟 p50 {summary['lateness_p50_us']:.1f}us "
+          f"p99 {summary['lateness_p99_us']:.1f}us 最大 {summary['lateness_max_us']:.1f}us")
+
+    result = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "clock": "realtime" if args.realtime else "simulated",
+            "pipeline": "compiled",  # 流式管线已移除，保留此项以拒绝与旧的流式基线对比
+            "instrument": args.instrument,
+            "fps": args.fps,
+            "max_keys": args.max_keys,
+            "max_keys_per_second": args.max_keys_per_second,
+            "numpy": args.numpy,
+            "repeat": args.repeat,
+        },
+        "summary": summary,
+        "songs": songs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        mismatched = mismatched_settings(baseline.get("meta", {}), result["meta"])
+        if mismatched:
+            print(f"基线与本次的运行设置不同，不做对比：{'，'.join(mismatched)}")
+            return 2
+        regressions = compare(summary, baseline["summary"], args.threshold)
+        if regressions:
+            print(f"变差超过 {args.threshold:g}%：{', '.join(regressions)}")
+            return 1
+    if summary["limit_violations"]:
+        print(f"实际发出的按下超出编排限制 {summary['limit_violations']} 次")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+按键发送微基准：对比旧的逐次构造 INPUT 与预分配的 SendInputBackend
+
+不会真正调用 SendInput，而是用一个记录内存块数的空函数代替，
+测量的是每个事件在 Python 侧的对象分配和耗时（一次调用发送多个事件时按事件数平均）。
+
+用法：python benchmark/bench_key_sender.py [-n 次数]
+"""
+import argparse
+import ctypes
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from 疯物之诗琴 import Input, Input_I, KeyBdInput, SendInputBackend, vk_lyre  # noqa: E402
+
+
+class FakeSendInput:
+    """代替 SendInput，记录调用瞬间已分配的内存块数"""
+
+    def __init__(self):
+        self.blocks = 0
+
+    def __call__(self, count, inputs, size):
+        self.blocks = sys.getallocatedblocks()
+        return count
+
+
+def legacy_send(send_input, hex_key_code, flags):
+    """改动前 press_key / release_key 的发送方式：每次都新建 ctypes 对象"""
+    extra = ctypes.c_ulong(0)
+    ii_ = Input_I()
+    ii_.ki = KeyBdInput(0, hex_key_code, flags, 0, ctypes.pointer(extra))
+    x = Input(ctypes.c_ulong(1), ii_)
+    send_input(1, ctypes.pointer(x), ctypes.sizeof(x))
+
+
+def allocations_per_call(fake, send_one, codes):
+    """SendInput 调用瞬间比调用前多出的内存块数，即每次调用的临时分配"""
+    total = 0
+    for hex_key_code in codes:
+        before = sys.getallocatedblocks()
+        send_one(hex_key_code)
+        total += fake.blocks - before
+    return total / len(codes)
+
+
+def seconds_per_call(send_one, codes, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for hex_key_code in codes:
+            send_one(hex_key_code)
+    return (time.perf_counter() - start) / (rounds * len(codes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按键发送微基准")
+    parser.add_argument("-n", "--rounds", type=int, default=5000, help="每种方式重复发送全部键位的轮数")
+    args = parser.parse_args()
+
+    codes = list(vk_lyre.values())
+    fake = FakeSendInput()
+    sender = SendInputBackend(send_input=fake)
+    chord_downs = [True] * len(codes)
+
+    # (名称, 发送函数, 每次调用发送的事件数)
+    cases = [
+        ("旧实现（逐次构造）", lambda c: legacy_send(fake, c, 0x0008), 1),
+        ("SendInputBackend 单键", sender.press, 1),
+        ("SendInputBackend 五键和弦", lambda c: sender.send(codes, chord_downs, 0, 5), 5),
+    ]
+
+    print(f"{'方式':<20}{'分配/事件':>12}{'耗时/事件':>14}")
+    for name, send_one, events in cases:
+        # 先预热一轮，排除首次调用的缓存分配
+        seconds_per_call(send_one, codes, 1)
+        allocations = allocations_per_call(fake, send_one, codes) / events
+        seconds = seconds_per_call(send_one, codes, args.rounds) / events
+        print(f"{name:<20}{allocations:>12.1f}{seconds * 1e6:>12.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,7 @@ a = Analysis(
         'win32api',
         'win32gui',
     ],
-    excludes=['rtmidi', 'mido.backends.rtmidi'],
+    excludes=['rtmidi', 'mido.backends.rtmidi', 'numpy'],  # numpy 只供批量工具使用，打包进去会拖慢启动
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -1,15 +1,56 @@
 #!/usr/bin/env python3
 # coding=utf-8
-import mido
+import csv
 import ctypes
-import win32api
+import heapq
 import time
 import json
 import os
+import sqlite3
 import sys
 import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from types import MappingProxyType
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from operator import itemgetter
 from PyQt5.QtCore import QThread, pyqtSignal
 
+# mido 导入较慢，第一次用到时再导入，窗口版可以先显示界面
+# numpy 只在批量工具调用 use_numpy() 后才使用：一首乐曲的直方图和调式得分用纯 Python 只要零点几毫秒，
+# 导入 numpy（约 120ms）反而会拖慢第一次演奏和每个索引进程，打包的程序也不包含它
+np = None
+_numpy_enabled = False
+_numpy_checked = False
+
+
+def use_numpy(enabled=True):
+    """批量分析大量乐曲的工具可以调用：之后尝试用 numpy 计算（未安装时仍用纯 Python 实现）"""
+    global _numpy_enabled
+    _numpy_enabled = enabled
+
+
+def _numpy():
+    """调用过 use_numpy() 时，首次调用尝试导入 numpy；返回模块或 None"""
+    global np, _numpy_checked
+    if not _numpy_enabled:
+        return None
+    if not _numpy_checked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+        _numpy_checked = True
+    return np
+
+
+def _mido():
+    import mido
+    return mido
+
 # ==================== 诗琴模式 (21键，无黑键) ====================
 # 键位映射：低音(Z-M) 中音(A-J) 高音(Q-U)
 key_lyre = ["z", "x", "c", "v", "b", "n", "m",
@@ -71,12 +112,43 @@ note_piano = [
 # 钢琴模式的实际可演奏范围 (36键)
 PIANO_RANGE = 36     # 36键
 
+
+
+class InstrumentLayout(namedtuple("InstrumentLayout", ["mode", "name", "keys", "vk", "notes"])):
+    """
+    乐器键位快照（不可变）
+
+    切换乐器模式时整体替换为另一个快照，正在演奏的会话继续使用自己开始时拿到的快照。
+    """
+    __slots__ = ()
+
+    @property
+    def is_piano(self):
+        return self.mode == 1
+
+    def note_map(self, base_note):
+        """MIDI 音高 -> 按键名，base_note 为最低八度"""
+        return {n + base_note * 12: k for n, k in zip(self.notes, self.keys)}
+
+
+INSTRUMENTS = (
+    InstrumentLayout(0, "诗琴模式 (21键，无黑键)", tuple(key_lyre), MappingProxyType(dict(vk_lyre)), tuple(note_lyre)),
+    InstrumentLayout(1, "钢琴模式 (36键，有黑键)", tuple(key_piano), MappingProxyType(dict(vk_piano)), tuple(note_piano)),
+)
+_instrument = INSTRUMENTS[0]
+
+
+def get_instrument():
+    """当前乐器的键位快照"""
+    return _instrument
+
+
 # ==================== 当前使用的映射 (默认诗琴模式) ====================
+# 兼容旧代码保留的可变副本，演奏时使用 InstrumentLayout 快照
 key = key_lyre.copy()
 vk = vk_lyre.copy()
 note = note_lyre.copy()
 
-pressed_key = set()
 configure = {}
 
 # 初始化默认 note_map (诗琴模式，base_note=3，即 C4-B6)
@@ -84,9 +156,9 @@ configure = {}
 note_map = {note_lyre[i] + 3 * 12: key_lyre[i] for i in range(len(note_lyre))}
 
 # 线程锁，保护共享资源的并发访问
-_pressed_key_lock = threading.Lock()
 _note_map_lock = threading.Lock()
 _configure_lock = threading.Lock()
+_configure_loaded = False
 
 # 调式识别相关
 KEY_SIGNATURES = {
@@ -203,6 +275,94 @@ configure_attr = {
         "get_tip": "MIDI文件目录",
         "default": "midi",
         "mode": "string"
+    },
+    "spin_window_ms": {
+        "set_tip": "演奏调度的忙等窗口（毫秒），每个音符截止前的这段时间内用忙等代替睡眠以提高精度，越大越准但越占CPU",
+        "get_tip": "调度忙等窗口（毫秒）",
+        "default": 2,
+        "mode": "int"
+    },
+    "stop_deadline_ms": {
+        "set_tip": "停止演奏的期限（毫秒），演奏线程超过这个时间仍未响应停止时强制松开所有按键",
+        "get_tip": "停止演奏期限（毫秒）",
+        "default": 50,
+        "mode": "int"
+    },
+    "timing_record": {
+        "set_tip": "是否记录每个按键的计划时间和实际发送时间（用于分析节奏不准的原因，窗口版会显示误差分布）",
+        "get_tip": "记录按键发送时间",
+        "default": 0,
+        "mode": "option",
+        "option": [
+            "不记录",
+            "记录"
+        ]
+    },
+    "frame_rate": {
+        "set_tip": "游戏帧率（如 60、120、144），按帧对齐按键事件并合并同一帧内的按键，短于一帧的音符也能被游戏识别；0 为不对齐",
+        "get_tip": "按帧对齐的帧率（0 为不对齐）",
+        "default": 0,
+        "mode": "int"
+    },
+    "min_down_frames": {
+        "set_tip": "按帧对齐时，每个键至少按住多少帧",
+        "get_tip": "最短按住帧数",
+        "default": 1,
+        "mode": "int"
+    },
+    "min_up_frames": {
+        "set_tip": "按帧对齐时，同一个键松开后至少隔多少帧才能再次按下",
+        "get_tip": "最短松开帧数",
+        "default": 1,
+        "mode": "int"
+    },
+    "max_keys_per_instant": {
+        "set_tip": "同一时刻最多按下几个键（0 为不限制）。多轨乐曲折叠到诗琴的21键后常有大量重复按键，限制后按优先级保留",
+        "get_tip": "同一时刻最多按键数（0 为不限制）",
+        "default": 0,
+        "mode": "int"
+    },
+    "max_keys_per_second": {
+        "set_tip": "每秒最多按下几次键（0 为不限制），过密的段落按优先级删去多余的音符",
+        "get_tip": "每秒最多按键数（0 为不限制）",
+        "default": 0,
+        "mode": "int"
+    },
+    "keep_melody": {
+        "set_tip": "限制按键数时，是否优先保留每个时刻的最高音（多为主旋律）",
+        "get_tip": "优先保留最高音",
+        "default": 1,
+        "mode": "option",
+        "option": [
+            "不优先",
+            "优先保留"
+        ]
+    },
+    "keep_bass": {
+        "set_tip": "限制按键数时，是否优先保留每个时刻的最低音（多为低音根音）",
+        "get_tip": "优先保留最低音",
+        "default": 1,
+        "mode": "option",
+        "option": [
+            "不优先",
+            "优先保留"
+        ]
+    },
+    "track_weights": {
+        "set_tip": "各音轨的优先级权重，格式如 1:2,3:0.5（音轨号:权重，未列出的为1，0为不演奏该音轨）",
+        "get_tip": "音轨权重",
+        "default": "",
+        "mode": "string"
+    },
+    "profile": {
+        "set_tip": "是否记录演奏各阶段（解析、分析、编译、演奏）的耗时，保存为 Chrome trace 文件 play_trace.json",
+        "get_tip": "记录各阶段耗时",
+        "default": 0,
+        "mode": "option",
+        "option": [
+            "不记录",
+            "记录"
+        ]
     }
 }
 
@@ -225,48 +385,33 @@ def switch_instrument_mode(mode):
     mode: 0 = 诗琴模式 (21键，无黑键)
           1 = 钢琴模式 (36键，有黑键)
     
-    注意：使用原地修改 (clear + extend/update) 而不是重新赋值，
+    当前乐器快照整体替换（一次赋值，正在演奏的会话不受影响）。
+    兼容旧代码的 key / vk / note 仍然原地修改 (clear + extend/update)，
     这样通过 'from ... import' 导入的变量也能看到更新。
     同时更新 note_map 的默认值。
     """
-    global key, vk, note, note_map
-    
-    if mode == 0:
-        # 原地修改列表
-        key.clear()
-        key.extend(key_lyre)
-        # 原地修改字典
-        vk.clear()
-        vk.update(vk_lyre)
-        # 原地修改列表
-        note.clear()
-        note.extend(note_lyre)
-        # 更新默认 note_map (base_note=3, 即 C4-B6)
-        with _note_map_lock:
-            note_map = {note_lyre[i] + 3 * 12: key_lyre[i] for i in range(len(note_lyre))}
-        print("已切换到诗琴模式 (21键，无黑键)")
-    elif mode == 1:
-        # 原地修改列表
-        key.clear()
-        key.extend(key_piano)
-        # 原地修改字典
-        vk.clear()
-        vk.update(vk_piano)
-        # 原地修改列表
-        note.clear()
-        note.extend(note_piano)
-        # 更新默认 note_map (base_note=3, 即 C3-B5, MIDI 36-71)
-        with _note_map_lock:
-            note_map = {note_piano[i] + 3 * 12: key_piano[i] for i in range(len(note_piano))}
-        print("已切换到钢琴模式 (36键，有黑键)")
+    global _instrument, note_map
+    
+    if mode not in (0, 1):
+        return mode
+    instrument = INSTRUMENTS[mode]
+    _instrument = instrument
+    
+    key[:] = instrument.keys
+    vk.clear()
+    vk.update(instrument.vk)
+    note[:] = instrument.notes
+    # 更新默认 note_map (base_note=3)
+    with _note_map_lock:
+        note_map = instrument.note_map(3)
+    print("已切换到" + instrument.name)
     
     return mode
 
 
 def is_piano_mode():
-    """检查当前是否为钢琴模式（线程安全）"""
-    with _configure_lock:
-        return configure.get("instrument_mode", 0) == 1
+    """检查当前是否为钢琴模式"""
+    return _instrument.is_piano
 
 
 def detect_key_signature(tracks):
@@ -280,6 +425,18 @@ def detect_key_signature(tracks):
                 note_class = msg.note % 12  # 获取音符类别(0-11)
                 note_count[note_class] += 1
     
+    best_key = key_from_pitch_classes([note_count[i] for i in range(12)])
+    print(f"检测到的调式: {best_key}")
+    return best_key
+
+
+def key_from_pitch_classes(note_count):
+    """根据12个音符类别的出现次数选出最匹配的调式"""
+    if _numpy() is not None:
+        scores = score_keys(note_count)
+        best = int(np.argmax(scores))
+        return KEY_NAMES[best] if scores[best] > 0 else "C"
+    
     # 检查每个可能的调式
     best_key = "C"
     best_score = 0
@@ -306,7 +463,6 @@ def detect_key_signature(tracks):
             best_score = score
             best_key = key_name
     
-    print(f"检测到的调式: {best_key}")
     return best_key
 
 
@@ -324,13 +480,30 @@ def transpose_to_c(midi_note, from_key):
     return transposed
 
 
+def fold_note(n, min_key, max_key, below_limit, above_limit):
+    """按 below_limit / above_limit 把超出 [min_key, max_key] 的音符折叠到可演奏范围"""
+    while n < min_key and below_limit > 0:
+        n += 12
+        if below_limit == 1:
+            break
+
+    while n > max_key and above_limit > 0:
+        n -= 12
+        if above_limit == 1:
+            break
+
+    return n
+
+
 def read_configure():
     """读取配置文件（线程安全）"""
-    global configure
+    global _configure_loaded
     with _configure_lock:
         if os.path.exists("configure.json"):
             with open("configure.json", encoding="utf-8") as file:
-                configure = json.loads(file.read())
+                # 原地更新，其他模块 import 的 configure 引用也能看到新配置
+                configure.clear()
+                configure.update(json.loads(file.read()))
         else:
             print("配置文件不存在")
             set_configure()
@@ -352,6 +525,13 @@ def read_configure():
                 elif conf["mode"] == "string":
                     print(conf["get_tip"] + "：" + str(configure[conf_key]))
         print_split_line()
+        _configure_loaded = True
+
+
+def ensure_configure():
+    """还没读取过配置文件时读取一次"""
+    if not _configure_loaded:
+        read_configure()
 
 
 def save_configure():
@@ -435,13 +615,21 @@ def get_base_note(bn_tracks):
                 min_note = min(min_note, bn_msg.note)
                 max_note = max(max_note, bn_msg.note)
     
-    # 打印音域信息
-    if min_note <= max_note:
-        note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        min_name = note_names[min_note % 12] + str(min_note // 12 - 1)
-        max_name = note_names[max_note % 12] + str(max_note // 12 - 1)
-        print(f"MIDI文件音域: {min_name} (MIDI {min_note}) - {max_name} (MIDI {max_note})")
-        print(f"跨越约 {(max_note - min_note) // 12 + 1} 个八度")
+    print_note_range(min_note, max_note)
+    base_note = base_note_from_octaves([note_count[i] for i in range(9)])
+    
+    # 打印映射信息
+    start_midi = base_note * 12
+    end_midi = start_midi + 35
+    print(f"选择 base_note={base_note}，映射范围: MIDI {start_midi}-{end_midi}")
+    
+    return base_note
+
+
+def base_note_from_octaves(note_count):
+    """根据9个八度（C1起）的音符数量，选出覆盖音符最多的3八度窗口，返回 base_note"""
+    if _numpy() is not None:
+        return int(np.argmax(score_octave_windows(note_count))) + 1
     
     # 计算每个可能的3八度窗口能覆盖多少音符
     # 窗口起始八度: 0=C1, 1=C2, 2=C3, ...
@@ -452,60 +640,67 @@ def get_base_note(bn_tracks):
     
     # 找到最佳窗口
     best_window = window_scores.index(max(window_scores))
-    base_note = best_window + 1  # 转换为 base_note (1-7)
-    
-    # 打印映射信息
-    start_midi = base_note * 12
-    end_midi = start_midi + 35
-    print(f"选择 base_note={base_note}，映射范围: MIDI {start_midi}-{end_midi}")
-    
-    return base_note
+    return best_window + 1  # 转换为 base_note (1-7)
+
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+def print_note_range(min_note, max_note):
+    """打印音域信息"""
+    if min_note <= max_note:
+        print(f"MIDI文件音域: {note_name(min_note)} (MIDI {min_note}) - {note_name(max_note)} (MIDI {max_note})")
+        print(f"跨越约 {(max_note - min_note) // 12 + 1} 个八度")
 
 
 def get_note(n):
     """
     处理音符，包括超范围和黑键处理（线程安全）
     
+    使用当前的 note_map、配置和乐器模式，演奏会话请直接调用 resolve_note 并传入自己的快照。
+    """
+    # 获取 note_map 的快照（线程安全）
+    with _note_map_lock:
+        if note_map is None:
+            return []
+        note_map_keys = sorted(note_map.keys())
+    
+    # 获取配置的快照（线程安全）
+    with _configure_lock:
+        below_limit = configure.get("below_limit", 2)
+        above_limit = configure.get("above_limit", 2)
+        black_keys = (configure.get("black_key_1", 0),
+                      configure.get("black_key_2", 3),
+                      configure.get("black_key_3", 3))
+    
+    return resolve_note(n, note_map_keys, below_limit, above_limit, black_keys, is_piano_mode())
+
+
+def resolve_note(n, note_map_keys, below_limit, above_limit, black_keys, piano):
+    """
+    把一个音符换算成要演奏的音高列表（纯函数，不读取全局状态）
+    
     对于36键钢琴模式：
     - 超出范围的音符会被折叠到可演奏范围内（升/降八度）
     - 支持完整的12音阶，无需黑键转换
     
     对于21键诗琴模式：
     - 超出范围的音符会被折叠到可演奏范围内
-    - 黑键会用邻近的白键代替
+    - 黑键会用邻近的白键代替，black_keys 为三个八度各自的黑键处理方式
+    
+    note_map_keys 为升序排列的可演奏音高。
     """
     n_list = []
     
-    # 获取 note_map 的快照（线程安全）
-    with _note_map_lock:
-        if note_map is None:
-            return n_list
-        note_map_keys = list(note_map.keys())
-    
     if not note_map_keys:
         return n_list
     
-    # 获取配置的快照（线程安全）
-    with _configure_lock:
-        below_limit = configure.get("below_limit", 2)
-        above_limit = configure.get("above_limit", 2)
-        black_key_1 = configure.get("black_key_1", 0)
-        black_key_2 = configure.get("black_key_2", 3)
-        black_key_3 = configure.get("black_key_3", 3)
-    
+    black_key_1, black_key_2, black_key_3 = black_keys
     min_key = note_map_keys[0]
     max_key = note_map_keys[-1]
     
     # 处理超出范围的音符 - 折叠到可演奏范围
-    while n < min_key and below_limit > 0:
-        n += 12
-        if below_limit == 1:
-            break
-
-    while n > max_key and above_limit > 0:
-        n -= 12
-        if above_limit == 1:
-            break
+    n = fold_note(n, min_key, max_key, below_limit, above_limit)
     
     # 再次检查是否在范围内（below_limit=0或above_limit=0时可能仍超出范围）
     if n < min_key or n > max_key:
@@ -513,7 +708,7 @@ def get_note(n):
         return n_list
 
     # 钢琴模式：直接支持黑键，无需转换
-    if is_piano_mode():
+    if piano:
         n_list.append(n)
         return n_list
     
@@ -557,13 +752,1113 @@ def get_note(n):
     return n_list
 
 
+def build_note_table(instrument, base_note, from_key="C", below_limit=2, above_limit=2, black_keys=(0, 3, 3)):
+    """
+    把一首曲子的完整映射（转调、折叠八度、黑键处理）预先算成 128 项的查找表
+
+    table[midi_note] 为要按下的虚拟键码元组（“同时演奏上下两个半音”时有两个），空元组表示不演奏。
+    命令行、演奏线程和批量工具都用这张表，逐个音符的映射只剩一次下标访问。
+    相同参数的表会被缓存。
+    """
+    return _build_note_table(instrument.mode, base_note, from_key, below_limit, above_limit, tuple(black_keys))
+
+
+@lru_cache(maxsize=64)
+def _build_note_table(mode, base_note, from_key, below_limit, above_limit, black_keys):
+    instrument = INSTRUMENTS[mode]
+    song_note_map = instrument.note_map(base_note)
+    note_map_keys = sorted(song_note_map)
+    table = []
+    for midi_note in range(128):
+        vk_codes = []
+        for n in resolve_note(transpose_to_c(midi_note, from_key), note_map_keys,
+                              below_limit, above_limit, black_keys, instrument.is_piano):
+            key_name = song_note_map.get(n)
+            if key_name is not None and instrument.vk[key_name] not in vk_codes:
+                vk_codes.append(instrument.vk[key_name])
+        table.append(tuple(vk_codes))
+    return tuple(table)
+
+
+# ==================== 性能剖析 ====================
+PROFILE_TRACE_FILE = "play_trace.json"  # Chrome trace 格式，每次演奏结束后覆盖为本次的记录，可在 chrome://tracing 或 Perfetto 中打开
+
+
+class _NullSpan:
+    """关闭剖析时 span() 返回的空区间，所有调用共用一个实例"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.profiler._local.depth = getattr(self.profiler._local, "depth", 0) + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        local = self.profiler._local
+        local.depth -= 1
+        self.profiler._add(self.name, self.start, end - self.start, local.depth, self.args)
+        return False
+
+
+ProfileMark = namedtuple("ProfileMark", ["sequence", "thread"])
+
+
+class Profiler:
+    """
+    可嵌套的命名计时区间
+
+    用法：with profiler.span("编译演奏计划"): ...
+    关闭时 span() 直接返回共享的空区间，开销只有一次方法调用，可以随时用 enable() 开关。
+    记录的区间可以打印为缩进的文本（report），也可以保存为 Chrome trace 文件（save）。
+    save() 会取走已保存的记录，每次演奏的 trace 只包含上一次保存之后的区间，记录不会一直累积。
+    每条记录带有递增的序号（保存后不归零），mark() 记下序号和调用线程，
+    report(mark) 只打印该线程此后的区间，中途被别的线程保存、或其他线程（如索引线程）的记录都不会混入。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._origin = time.perf_counter()
+        self._records = []  # (名称, 开始, 耗时, 线程号, 线程名, 嵌套深度, 参数, 序号)
+        self._sequence = 0  # 已记录的总条数，作为下一条记录的序号
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, enabled=True):
+        self.enabled = bool(enabled)
+
+    def span(self, name, **args):
+        """返回一个计时区间（上下文管理器），args 会写入 trace 的参数"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def instant(self, name, **args):
+        """记录一个瞬时事件（例如第一个音符发出）"""
+        if self.enabled:
+            self._add(name, time.perf_counter(), None, getattr(self._local, "depth", 0), args)
+
+    def mark(self):
+        """返回当前位置和调用线程，配合 report(since) 只打印该线程之后的区间"""
+        return ProfileMark(self._sequence, threading.get_ident())
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def _add(self, name, start, duration, depth, args):
+        thread = threading.current_thread()
+        with self._lock:
+            self._records.append((name, start, duration, thread.ident, thread.name, depth, args, self._sequence))
+            self._sequence += 1
+
+    def report(self, since=None):
+        """按开始时间排列、按嵌套深度缩进的文本；since 为 mark() 的返回值，为空时打印所有线程的全部记录"""
+        with self._lock:
+            records = list(self._records)
+            oldest = records[0][7] if records else self._sequence
+        lines = []
+        if since is not None:
+            records = [record for record in records if record[7] >= since.sequence and record[3] == since.thread]
+            if oldest > since.sequence:
+                lines.append("（之前的部分记录已被保存并清空，不在此列出）")
+        records.sort(key=itemgetter(1))
+        for name, start, duration, _, _, depth, _, _ in records:
+            offset = (start - self._origin) * 1000
+            cost = "" if duration is None else f" {duration * 1000:.2f}ms"
+            lines.append(f"{'  ' * depth}{name}{cost}（+{offset:.1f}ms）")
+        return "\n".join(lines)
+
+    def save(self, path=PROFILE_TRACE_FILE):
+        """
+        把上一次保存之后的记录保存为 Chrome trace 格式（时间单位为微秒），保存后清空这些记录
+
+        没有新记录时不写文件（不覆盖上一次的 trace），返回保存的记录数。
+        """
+        pid = os.getpid()
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return 0
+        events = []
+        thread_names = {}
+        for name, start, duration, tid, thread_name, _, args, _ in records:
+            thread_names[tid] = thread_name
+            event = {"name": name, "cat": "play", "pid": pid, "tid": tid,
+                     "ts": (start - self._origin) * 1e6, "args": args}
+            if duration is None:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=duration * 1e6)
+            events.append(event)
+        for tid, thread_name in thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": thread_name}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(records)
+
+
+profiler = Profiler()
+
+
+# ==================== 乐曲分析内核 ====================
+# 以下函数只依赖音高数组和直方图，也可供批量工具直接调用
+KEY_NAMES = list(KEY_ROOT_OFFSET.keys())
+MIDI_DEFAULT_TEMPO = 500000  # 120 BPM
+
+
+def extract_song_notes(midi):
+    """
+    一次遍历原始音轨，取出所有 note_on 音高并计算时长
+
+    不经过 mido 的音轨合并和逐条消息复制，比遍历 MidiFile 快得多。
+    返回 (音高数组 array('B'), 时长秒)
+    """
+    pitches = array("B")
+    tempo_changes = []
+    end_tick = 0
+    for track in midi.tracks:
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            msg_type = msg.type
+            if msg_type == "note_on":
+                if msg.velocity > 0:
+                    pitches.append(msg.note)
+            elif msg_type == "set_tempo":
+                tempo_changes.append((tick, msg.tempo))
+        end_tick = max(end_tick, tick)
+
+    # 与合并音轨时的顺序一致：按 tick 稳定排序
+    tempo_changes.sort(key=lambda change: change[0])
+    seconds_per_tick = 1e-6 / midi.ticks_per_beat
+    length = 0.0
+    tempo = MIDI_DEFAULT_TEMPO
+    last_tick = 0
+    for tick, new_tempo in tempo_changes:
+        length += (tick - last_tick) * tempo * seconds_per_tick
+        last_tick = tick
+        tempo = new_tempo
+    length += (end_tick - last_tick) * tempo * seconds_per_tick
+    return pitches, length
+
+
+def note_histogram(pitches):
+    """128 个 MIDI 音高各自的出现次数"""
+    if _numpy() is not None:
+        return np.bincount(np.frombuffer(pitches, dtype=np.uint8), minlength=128).tolist()
+    note_count = [0] * 128
+    for n in pitches:
+        note_count[n] += 1
+    return note_count
+
+
+def _build_key_templates():
+    """每个调式一行：自然音阶各音权重 1，主音再加 2，属音再加 1.5（与 key_from_pitch_classes 一致）"""
+    templates = np.zeros((len(KEY_NAMES), 12))
+    for row, root_offset in enumerate(KEY_ROOT_OFFSET.values()):
+        for degree in (0, 2, 4, 5, 7, 9, 11):
+            templates[row, (degree + root_offset) % 12] += 1
+        templates[row, root_offset % 12] += 2
+        templates[row, (root_offset + 7) % 12] += 1.5
+    return templates
+
+
+KEY_TEMPLATES = None  # 首次调用 score_keys 时生成
+
+
+def score_keys(pitch_classes):
+    """一次矩阵乘法算出所有调式的得分，顺序同 KEY_NAMES（需要 numpy）"""
+    global KEY_TEMPLATES
+    if KEY_TEMPLATES is None:
+        KEY_TEMPLATES = _build_key_templates()
+    return KEY_TEMPLATES @ np.asarray(pitch_classes, dtype=np.float64)
+
+
+def score_octave_windows(octaves):
+    """用卷积算出 7 个 3 八度窗口各覆盖多少音符（需要 numpy）"""
+    return np.convolve(np.asarray(octaves, dtype=np.int64), np.ones(3, dtype=np.int64), mode="valid")
+
+
+# ==================== 乐曲分析与缓存 ====================
+class SongAnalysis(namedtuple("SongAnalysis", [
+        "length", "note_count", "pitch_classes", "octaves",
+        "min_note", "max_note", "detected_key", "base_note"])):
+    """
+    一次遍历得到的乐曲分析结果（不可变）
+
+    length:        乐曲总时长（秒）
+    note_count:    128 个 MIDI 音高各自的 note_on 次数
+    pitch_classes: 12 个音符类别的出现次数（调式识别用）
+    octaves:       9 个八度（C1起）的音符数量（选择 base_note 用）
+    min_note / max_note: 音域，没有音符时 min_note > max_note
+    detected_key:  自动识别的调式
+    base_note:     自动选择的基础音高
+    """
+    __slots__ = ()
+
+
+def analyze_song(midi):
+    """
+    一次遍历 MidiFile，同时得到时长、音高直方图、调式和 base_note
+    替代分别调用 midi.length、detect_key_signature 和 get_base_note 的三次遍历
+    """
+    pitches, length = extract_song_notes(midi)
+    return analysis_from_counts(length, note_histogram(pitches))
+
+
+def analysis_from_counts(length, note_count):
+    """由时长和 128 个音高的出现次数推出其余分析结果"""
+    if _numpy() is not None:
+        counts = np.zeros(132, dtype=np.int64)
+        counts[:128] = note_count
+        pitch_classes = counts.reshape(11, 12).sum(axis=0).tolist()
+        octaves = counts[12:120].reshape(9, 12).sum(axis=1).tolist()  # C1=12 对应 octave=0
+        used = np.flatnonzero(counts)
+        min_note = int(used[0]) if len(used) else 127
+        max_note = int(used[-1]) if len(used) else 0
+    else:
+        pitch_classes = [0] * 12
+        octaves = [0] * 9
+        min_note = 127
+        max_note = 0
+        for n, count in enumerate(note_count):
+            if count:
+                pitch_classes[n % 12] += count
+                octave = (n - 12) // 12  # C1=12 对应 octave=0
+                if 0 <= octave < 9:
+                    octaves[octave] += count
+                min_note = min(min_note, n)
+                max_note = max(max_note, n)
+
+    return SongAnalysis(length, tuple(note_count), tuple(pitch_classes), tuple(octaves),
+                        min_note, max_note, key_from_pitch_classes(pitch_classes),
+                        base_note_from_octaves(octaves))
+
+
+class LoadedSong:
+    """
+    已加载的乐曲：分析结果，以及按映射参数缓存的演奏计划
+
+    mido 的 MidiFile 每条消息约 250 字节，演奏计划每个事件只有 10 字节，
+    因此 MidiFile 只保留到编译出第一份演奏计划为止；之后切换乐器、帧对齐或编排参数
+    需要新的演奏计划时再从文件重新解析。缓存的内存占用由紧凑的演奏计划决定。
+    """
+    __slots__ = ("path", "midi", "analysis", "_compiled")
+
+    def __init__(self, path, midi):
+        self.path = path
+        self.midi = midi  # 编译出第一份演奏计划后释放
+        with profiler.span("分析乐曲"):
+            self.analysis = analyze_song(midi)
+        self._compiled = {}
+
+    def compile(self, note_table, quantizer=None, limiter=None):
+        """获取演奏计划，同一张查找表、帧对齐和编排参数只编译一次"""
+        cache_key = (note_table, quantizer, limiter)
+        song = self._compiled.get(cache_key)
+        if song is None:
+            midi = self.midi
+            if midi is None:
+                with profiler.span("解析 MIDI", path=os.path.basename(self.path)):
+                    midi = _mido().MidiFile(self.path)
+            with profiler.span("编译演奏计划"):
+                song = compile_song(midi, note_table, quantizer, limiter)
+            self._compiled[cache_key] = song
+            self.midi = None
+        return song
+
+
+class SongCache:
+    """
+    已加载乐曲的内存缓存
+
+    以 (绝对路径, 修改时间, 文件大小) 为键，文件变化后自动失效；
+    最多保留 max_songs 首，按最近使用淘汰（LRU）。每首只占分析结果和演奏计划的内存（见 LoadedSong）。
+    """
+
+    def __init__(self, max_songs=8):
+        self.max_songs = max_songs
+        self._songs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        cache_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            song = self._songs.get(cache_key)
+            if song is not None:
+                self._songs.move_to_end(cache_key)
+                return song
+
+        # 解析放在锁外，避免阻塞其他线程读取缓存
+        with profiler.span("解析 MIDI", path=os.path.basename(path)):
+            midi = _mido().MidiFile(path)
+        song = LoadedSong(cache_key[0], midi)
+        with self._lock:
+            self._songs[cache_key] = song
+            self._songs.move_to_end(cache_key)
+            while len(self._songs) > self.max_songs:
+                self._songs.popitem(last=False)
+        return song
+
+
+_song_cache = SongCache()
+
+
+def load_song(path):
+    """读取乐曲（带缓存），重复演奏和跳转不会重新解析"""
+    with profiler.span("加载乐曲"):
+        return _song_cache.get(path)
+
+
+def choose_base_note(analysis, lowest_pitch_name):
+    """lowest_pitch_name 为 -1 时使用分析得到的 base_note，并打印音域和映射信息"""
+    if lowest_pitch_name != -1:
+        return lowest_pitch_name
+    print_note_range(analysis.min_note, analysis.max_note)
+    base_note = analysis.base_note
+    start_midi = base_note * 12
+    print(f"选择 base_note={base_note}，映射范围: MIDI {start_midi}-{start_midi + 35}")
+    return base_note
+
+
+def playable_ratio(analysis):
+    """按当前乐器模式和配置，计算乐曲中能被演奏出来的音符比例（与演奏时使用同一张查找表）"""
+    total = sum(analysis.note_count)
+    if total == 0:
+        return 0.0
+    config = PlaybackConfig.capture()
+    from_key = analysis.detected_key if config.auto_transpose == 1 else "C"
+    base_note = analysis.base_note if config.lowest_pitch_name == -1 else config.lowest_pitch_name
+    table = build_note_table(get_instrument(), base_note, from_key,
+                             config.below_limit, config.above_limit, config.black_keys)
+    count = sum(note_total for n, note_total in enumerate(analysis.note_count) if table[n])
+    return count / total
+
+
+def note_density(analysis):
+    """平均每秒音符数"""
+    return sum(analysis.note_count) / analysis.length if analysis.length > 0 else 0.0
+
+
+def note_name(midi_note):
+    """MIDI 音高转音名，如 60 -> C4"""
+    return NOTE_NAMES[midi_note % 12] + str(midi_note // 12 - 1)
+
+
+# ==================== 乐曲信息磁盘缓存 ====================
+# 与 configure.json 放在同一目录
+SONG_INFO_DB = "song_cache.db"
+# 分析逻辑变化时递增，旧缓存会整体失效
+SONG_INFO_VERSION = 1
+
+
+class SongInfo(namedtuple("SongInfo", ["analysis", "tracks"])):
+    """
+    乐曲库中一首曲子的信息
+
+    analysis: SongAnalysis
+    tracks:   每个音轨的 (名称, 音符数)
+    """
+    __slots__ = ()
+
+
+def song_info_from_midi(midi, analysis):
+    """由已解析的 MidiFile 和分析结果生成 SongInfo"""
+    tracks = []
+    for track in midi.tracks:
+        notes = sum(1 for msg in track if msg.type == "note_on" and msg.velocity > 0)
+        tracks.append((track.name, notes))
+    return SongInfo(analysis, tuple(tracks))
+
+
+def analyze_file(path):
+    """解析并分析一个 MIDI 文件（不经过内存缓存，适合批量建立乐曲库）"""
+    midi = _mido().MidiFile(path)
+    return song_info_from_midi(midi, analyze_song(midi))
+
+
+class SongInfoCache:
+    """
+    乐曲分析结果的持久化缓存（SQLite 单文件）
+
+    以 (绝对路径, 修改时间, 文件大小) 判断是否有效：文件被修改后旧记录自动作废并重新分析，
+    文件被删除后由 prune 清除。缓存命中时完全不需要解析 MIDI。
+    """
+
+    def __init__(self, db_path=SONG_INFO_DB):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SONG_INFO_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS songs")
+                self._conn.execute(f"PRAGMA user_version = {SONG_INFO_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS songs ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+                "length REAL, note_count TEXT, tracks TEXT)")
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path):
+        """返回有效的缓存记录，没有或已过期时返回 None"""
+        abs_path, mtime_ns, size = self._file_key(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT length, note_count, tracks FROM songs WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (abs_path, mtime_ns, size)).fetchone()
+        if row is None:
+            return None
+        length, note_count, tracks = row
+        analysis = analysis_from_counts(length, json.loads(note_count))
+        return SongInfo(analysis, tuple(tuple(track) for track in json.loads(tracks)))
+
+    def put(self, path, info):
+        """写入（或替换过期的）缓存记录"""
+        abs_path, mtime_ns, size = self._file_key(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?)",
+                (abs_path, mtime_ns, size, info.analysis.length,
+                 json.dumps(info.analysis.note_count), json.dumps(info.tracks, ensure_ascii=False)))
+
+    def get_or_analyze(self, path):
+        """读取缓存，未命中时解析分析并写回"""
+        info = self.get(path)
+        if info is None:
+            info = analyze_file(path)
+            self.put(path, info)
+        return info
+
+    def prune(self, paths):
+        """删除不在 paths 中的记录（文件已被删除或移走）"""
+        keep = {os.path.abspath(path) for path in paths}
+        with self._lock, self._conn:
+            stale = [(row[0],) for row in self._conn.execute("SELECT path FROM songs") if row[0] not in keep]
+            self._conn.executemany("DELETE FROM songs WHERE path = ?", stale)
+        return len(stale)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ==================== 按键事件管线 ====================
+# 逐条产出的生成器，由 compile_song 串起来写入演奏计划
+
+
+def _track_ticks(track_index, track):
+    """逐条产出音轨中的 (绝对 tick, 音轨号, 消息)"""
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        yield tick, track_index, msg
+
+
+def iter_timed_messages(midi):
+    """
+    按演奏顺序逐条产出 (绝对时间秒, 消息, 音轨号)，不生成合并后的音轨
+
+    各音轨用 heapq.merge 按 tick 归并，同一 tick 按音轨顺序，与 mido 合并音轨的顺序一致；
+    秒数遇到 set_tempo 时即时换算，结果与遍历 MidiFile 累加 msg.time 完全相同。
+    和 mido 一样，各音轨的 end_of_track 合并为最后一条。
+    """
+    ticks_per_beat = midi.ticks_per_beat
+    tempo = MIDI_DEFAULT_TEMPO
+    now = 0.0
+    last_tick = 0
+    end_tick = 0
+    end_of_track = None
+    end_track = 0
+    tracks = (_track_ticks(index, track) for index, track in enumerate(midi.tracks))
+    for tick, track_index, msg in heapq.merge(*tracks, key=itemgetter(0)):
+        if msg.type == "end_of_track":
+            end_tick = tick
+            end_of_track = msg
+            end_track = track_index
+            continue
+        if tick > last_tick:
+            now += (tick - last_tick) * (tempo * 1e-6 / ticks_per_beat)
+            last_tick = tick
+        yield now, msg, track_index
+        if msg.type == "set_tempo":
+            tempo = msg.tempo
+
+    if end_of_track is not None:
+        if end_tick > last_tick:
+            now += (end_tick - last_tick) * (tempo * 1e-6 / ticks_per_beat)
+        yield now, end_of_track, end_track
+
+
+def iter_key_events(timed_messages, note_table):
+    """
+    将 (秒, 消息, 音轨号) 流映射为按键事件流 (秒, 虚拟键码, 是否按下)
+
+    note_table 为 build_note_table 生成的查找表；重复按下同一个键时先插入一个释放事件。
+    """
+    held = set()
+    for now, msg, _ in timed_messages:
+        msg_type = msg.type
+        if msg_type != "note_on" and msg_type != "note_off":
+            continue
+
+        vk_codes = note_table[msg.note]
+        if not vk_codes:
+            continue
+
+        # velocity 为 0 的 note_on 等同于 note_off
+        down = msg_type == "note_on" and msg.velocity > 0
+        for vk_code in vk_codes:
+            if vk_code in held:
+                held.discard(vk_code)
+                yield now, vk_code, False
+            if down:
+                held.add(vk_code)
+                yield now, vk_code, True
+
+
+class ArrangementReport:
+    """编排阶段保留和删去的音符数，按删去的原因分类"""
+    __slots__ = ("kept", "duplicate", "polyphony", "density", "muted")
+
+    def __init__(self):
+        self.kept = 0
+        self.duplicate = 0  # 与同一时刻已保留的音符落在相同的键上
+        self.polyphony = 0  # 超过同一时刻最多按键数
+        self.density = 0  # 超过每秒最多按键数
+        self.muted = 0  # 所在音轨权重为 0
+
+    @property
+    def removed(self):
+        return self.duplicate + self.polyphony + self.density + self.muted
+
+    def describe(self):
+        return (f"编排：保留 {self.kept} 个音符，删去 {self.removed} 个（重复按键 {self.duplicate}，"
+                f"超过同时按键数 {self.polyphony}，超过每秒按键数 {self.density}，静音音轨 {self.muted}）")
+
+
+def parse_track_weights(text):
+    """解析 "音轨号:权重,..." 格式的音轨权重，返回按音轨号排序的 ((音轨号, 权重), ...)，格式错误的项忽略"""
+    weights = {}
+    for item in str(text or "").replace("，", ",").split(","):
+        track, _, weight = item.partition(":")
+        try:
+            weights[int(track)] = float(weight)
+        except ValueError:
+            if item.strip():
+                print(f"音轨权重格式错误，已忽略：{item.strip()}")
+    return tuple(sorted(weights.items()))
+
+
+class NoteLimiter(namedtuple("NoteLimiter", [
+        "max_keys_per_instant", "max_keys_per_second", "keep_melody", "keep_bass", "track_weights"])):
+    """
+    编排阶段：限制同时按键数和每秒按键数（不可变，可作为演奏计划缓存的键）
+
+    多轨乐曲同一时刻常有 8～12 个音，折叠到诗琴的 21 个键后大量落在相同的键上。
+    每个时刻的音符按优先级排序后依次保留：最高音（主旋律）、最低音（低音根音）优先，
+    其余按音轨权重、力度、音高从高到低；所有键都已被保留的音符按下的音符直接删去，
+    会让这一时刻的按下次数超过 max_keys_per_instant、或最近一秒内超过 max_keys_per_second 的也删去
+    （0 为不限制）。按下次数按音符实际发出的按键计算，黑键同时演奏上下两个半音时算两次。
+    track_weights 为 ((音轨号, 权重), ...)，未列出的音轨权重为 1，权重为 0 的音轨不演奏。
+    被删去的音符对应的 note_off 一并删去，不会提前松开别的音符按住的键。
+    """
+    __slots__ = ()
+
+    def apply(self, timed_messages, note_table, report=None):
+        """过滤 (秒, 消息, 音轨号) 流，每次只缓存同一时刻的消息；删去的音符数累计到 report"""
+        if report is None:
+            report = ArrangementReport()
+        max_per_instant = self.max_keys_per_instant
+        max_per_second = self.max_keys_per_second
+        weights = dict(self.track_weights)
+        recent = deque()  # 最近一秒内按下的时间，每个键一项
+        removed = {}  # (音轨号, 通道, 音高) -> 被删去、还没结束的音符数
+        instant = []
+        instant_time = None
+
+        def choose(messages, now):
+            """返回这一时刻要删去的 note_on 在 messages 中的下标"""
+            notes = []
+            dropped = set()
+            for i, (_, msg, track) in enumerate(messages):
+                if msg.type == "note_on" and msg.velocity > 0 and note_table[msg.note]:
+                    if weights.get(track, 1) > 0:
+                        notes.append((i, msg, track))
+                    else:
+                        report.muted += 1
+                        dropped.add(i)
+            if not notes:
+                return dropped
+            melody = max(msg.note for _, msg, _ in notes) if self.keep_melody else None
+            bass = min(msg.note for _, msg, _ in notes) if self.keep_bass else None
+            notes.sort(key=lambda note: (note[1].note == melody, note[1].note == bass,
+                                         weights.get(note[2], 1), note[1].velocity, note[1].note), reverse=True)
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            used = set()
+            presses = 0  # 这一时刻实际会发出的按下次数
+            for i, msg, track in notes:
+                # iter_key_events 会按下音符对应的每一个键（已按下的键先松开再按），全部计入预算
+                keys = note_table[msg.note]
+                if used.issuperset(keys):
+                    report.duplicate += 1
+                elif max_per_instant and presses + len(keys) > max_per_instant:
+                    report.polyphony += 1
+                elif max_per_second and len(recent) + len(keys) > max_per_second:
+                    report.density += 1
+                else:
+                    report.kept += 1
+                    used.update(keys)
+                    presses += len(keys)
+                    recent.extend([now] * len(keys))
+                    continue
+                dropped.add(i)
+            return dropped
+
+        def flush(messages, now):
+            dropped = choose(messages, now)
+            for i, message in enumerate(messages):
+                msg = message[1]
+                if msg.type == "note_on" or msg.type == "note_off":
+                    note_key = (message[2], msg.channel, msg.note)
+                    if i in dropped:
+                        removed[note_key] = removed.get(note_key, 0) + 1
+                        continue
+                    if (msg.type == "note_off" or msg.velocity == 0) and removed.get(note_key):
+                        removed[note_key] -= 1
+                        continue
+                yield message
+
+        for message in timed_messages:
+            if instant and message[0] != instant_time:
+                yield from flush(instant, instant_time)
+                instant = []
+            instant_time = message[0]
+            instant.append(message)
+        if instant:
+            yield from flush(instant, instant_time)
+
+
+class FrameQuantizer(namedtuple("FrameQuantizer", ["fps", "min_down_frames", "min_up_frames"])):
+    """
+    按游戏帧对齐按键事件（不可变，可作为演奏计划缓存的键）
+
+    游戏每帧只读取一次键盘状态：事件时间取整到最近的帧，同一帧的事件合并为一批发送；
+    按住不足 min_down_frames 帧或松开不足 min_up_frames 帧的键顺延到满足为止，
+    短于一帧的装饰音也能被游戏识别。同一个键重复得太快、按下需要顺延超过
+    max(min_down_frames, min_up_frames) 帧时不再重按：这时上一次松开一定还没发出
+    （已发出的松开早于当前帧，顺延不会超过 min_up_frames），取消它，两个音合并为一次按住。
+    误差不会累积。
+    """
+    __slots__ = ()
+
+    def apply(self, key_events):
+        """对按键事件流 (秒, 虚拟键码, 是否按下) 做对齐，产出同样格式的事件流"""
+        fps = self.fps
+        min_down_frames = self.min_down_frames
+        min_up_frames = self.min_up_frames
+        max_delay = max(min_down_frames, min_up_frames)
+        never = -(1 << 30)
+        pending = []  # 等待发出的事件（最小堆）：(帧, 序号, 虚拟键码, 是否按下)
+        sequence = 0
+        down_frames = {}  # 键 -> 最近一次按下所在帧
+        up_frames = {}  # 键 -> 最近一次松开所在帧
+        pending_ups = {}  # 键 -> 还在堆里的松开事件的序号
+        cancelled = set()  # 被取消的松开事件的序号
+
+        for event_time, vk_code, down in key_events:
+            frame = int(event_time * fps + 0.5)
+            # 之后的事件都不会早于这一帧，更早的事件可以发出了
+            while pending and pending[0][0] < frame:
+                pending_frame, pending_sequence, pending_vk, pending_down = heapq.heappop(pending)
+                if pending_sequence in cancelled:
+                    cancelled.discard(pending_sequence)
+                    continue
+                if not pending_down and pending_ups.get(pending_vk) == pending_sequence:
+                    del pending_ups[pending_vk]
+                yield pending_frame / fps, pending_vk, pending_down
+
+            if down:
+                ready = up_frames.get(vk_code, never) + min_up_frames
+                if ready - frame > max_delay:
+                    # 松开还没发出：取消它，键一直按住，之后的松开照常发出
+                    cancelled.add(pending_ups.pop(vk_code))
+                    up_frames.pop(vk_code, None)
+                    continue
+                frame = max(frame, ready)
+                down_frames[vk_code] = frame
+            else:
+                frame = max(frame, down_frames.get(vk_code, never) + min_down_frames)
+                up_frames[vk_code] = frame
+                pending_ups[vk_code] = sequence
+            heapq.heappush(pending, (frame, sequence, vk_code, down))
+            sequence += 1
+
+        while pending:
+            pending_frame, pending_sequence, pending_vk, pending_down = heapq.heappop(pending)
+            if pending_sequence not in cancelled:
+                yield pending_frame / fps, pending_vk, pending_down
+
+
+# ==================== 预编译演奏计划 ====================
+# 每隔多少个事件保存一次按键状态快照，跳转时最多重放这么多事件
+SEEK_CHECKPOINT_INTERVAL = 256
+
+
+class CompiledSong(namedtuple("CompiledSong", ["times", "vks", "downs", "length", "checkpoints", "arrangement"],
+                              defaults=(None,))):
+    """
+    预编译的演奏计划（不可变，按列存放在紧凑数组中，每个事件约 10 字节）
+
+    times: array('d')，每个按键事件的绝对时间（秒，升序），同时作为跳转用的时间索引
+    vks:   array('B')，每个事件对应的虚拟键码
+    downs: array('B')，每个事件是否为按下（1 按下 / 0 释放）
+    length: 乐曲总时长（秒）
+    checkpoints: 第 k 项为演奏到第 k * SEEK_CHECKPOINT_INTERVAL 个事件之前处于按下状态的键
+    arrangement: 经过 NoteLimiter 编排时为 ArrangementReport，否则为 None
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def nbytes(self):
+        """事件数组占用的字节数（不含快照）"""
+        return sum(len(column) * column.itemsize for column in (self.times, self.vks, self.downs))
+
+    def seek(self, song_time):
+        """返回 song_time 处第一个尚未演奏的事件下标（二分查找）"""
+        return bisect_left(self.times, song_time)
+
+    def held_keys_at(self, index):
+        """返回演奏到第 index 个事件之前应处于按下状态的键（从最近的快照重放）"""
+        checkpoint = index // SEEK_CHECKPOINT_INTERVAL
+        held = set(self.checkpoints[checkpoint])
+        downs = self.downs
+        vks = self.vks
+        for i in range(checkpoint * SEEK_CHECKPOINT_INTERVAL, index):
+            if downs[i]:
+                held.add(vks[i])
+            else:
+                held.discard(vks[i])
+        return held
+
+    def batches(self, index=0):
+        """从第 index 个事件开始，产出同一时刻的一批事件 (时间, vks, downs, 起始下标, 结束下标)"""
+        times = self.times
+        vks = self.vks
+        downs = self.downs
+        event_count = len(times)
+        while index < event_count:
+            event_time = times[index]
+            batch_end = index + 1
+            while batch_end < event_count and times[batch_end] == event_time:
+                batch_end += 1
+            yield event_time, vks, downs, index, batch_end
+            index = batch_end
+
+
+def compile_song(midi, note_table, quantizer=None, limiter=None):
+    """
+    将 MidiFile 预编译为演奏计划
+
+    note_table 为 build_note_table 生成的查找表，转调、折叠八度、黑键处理都已经包含在里面，
+    演奏循环只需要等待和发送按键。事件即 iter_key_events 产出的事件。
+    quantizer 为 FrameQuantizer 时按游戏帧对齐事件，limiter 为 NoteLimiter 时先做编排。
+    """
+    times = array("d")
+    vks = array("B")
+    downs = array("B")
+    checkpoints = []
+    held = set()
+    now = 0.0
+
+    def timed_messages():
+        nonlocal now  # 最后一条消息的时间即乐曲总时长
+        for message in iter_timed_messages(midi):
+            now = message[0]
+            yield message
+
+    messages = timed_messages()
+    report = None
+    if limiter is not None:
+        report = ArrangementReport()
+        messages = limiter.apply(messages, note_table, report)
+    key_events = iter_key_events(messages, note_table)
+    if quantizer is not None:
+        key_events = quantizer.apply(key_events)
+    for event_time, vk_code, down in key_events:
+        if len(times) % SEEK_CHECKPOINT_INTERVAL == 0:
+            checkpoints.append(frozenset(held))
+        times.append(event_time)
+        vks.append(vk_code)
+        downs.append(down)
+        if down:
+            held.add(vk_code)
+        else:
+            held.discard(vk_code)
+
+    if len(times) % SEEK_CHECKPOINT_INTERVAL == 0:
+        checkpoints.append(frozenset(held))
+
+    return CompiledSong(times, vks, downs, now, tuple(checkpoints), report)
+
+
+def playback_batches(loaded, note_table, start_time=0.0, quantizer=None, limiter=None):
+    """
+    准备从 start_time 开始演奏，返回 (此刻应按住的键, 按时刻分批的事件迭代器)
+
+    所有乐曲都使用缓存的演奏计划（每个事件 10 字节，远小于 MidiFile 本身），跳转为二分查找。
+    """
+    song = loaded.compile(note_table, quantizer, limiter)
+    print(f"已预编译 {len(song)} 个按键事件")
+    if song.arrangement is not None:
+        print(song.arrangement.describe())
+    with profiler.span("跳转"):
+        index = song.seek(start_time)
+        held = song.held_keys_at(index)
+    return held, song.batches(index)
+
+
+# ==================== 演奏调度 ====================
+LATENESS_SAMPLES = 1 << 16  # 调度器保留最近多少个事件的延迟用于计算分位数
+
+
+class DeadlineScheduler:
+    """
+    基于绝对截止时间的调度器
+
+    每个事件的截止时间 = 起点 + 事件在乐曲中的时间，统一用 time.perf_counter() 计算，
+    处理耗时和定时器误差不会像逐个 sleep(msg.time) 那样累积。
+    等待分两段：先用 stop_event.wait 粗睡眠（可被停止打断），
+    截止前 spin_window 秒内改为忙等，以绕开系统定时器精度。
+    延迟（实际到达时间与截止时间之差）只累计次数、总和与最大值，另用环形缓冲区保留最近
+    LATENESS_SAMPLES 个算分位数，很长的乐曲演奏时内存也不会增长。
+    """
+
+    def __init__(self, stop_event, spin_window=0.002, clock=time.perf_counter):
+        self.stop_event = stop_event
+        self.spin_window = spin_window
+        self.clock = clock
+        self.origin = clock()
+        self._samples = array("d", bytes(8 * LATENESS_SAMPLES))
+        self._reset_lateness()
+
+    def _reset_lateness(self):
+        self.late_count = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+    def start(self, song_time=0.0):
+        """从乐曲的 song_time 秒处开始计时"""
+        self.origin = self.clock() - song_time
+        self._reset_lateness()
+
+    def resume(self, song_time):
+        """暂停后从乐曲的 song_time 秒处继续计时，保留已记录的延迟"""
+        self.origin = self.clock() - song_time
+
+    def now(self):
+        """当前乐曲时间（秒）"""
+        return self.clock() - self.origin
+
+    def wait_until(self, song_time):
+        """等待到乐曲时间 song_time，返回True表示按时到达，False表示被停止"""
+        clock = self.clock
+        deadline = self.origin + song_time
+        coarse = deadline - clock() - self.spin_window
+        if coarse > 0 and self.stop_event.wait(timeout=coarse):
+            return False
+        while clock() < deadline:
+            if self.stop_event.is_set():
+                return False
+        late = clock() - deadline
+        self._samples[self.late_count % LATENESS_SAMPLES] = late
+        self.late_count += 1
+        self.late_total += late
+        if late > self.late_max:
+            self.late_max = late
+        return True
+
+    def lateness(self):
+        """最近（最多 LATENESS_SAMPLES 个）事件的延迟（秒），顺序不保证"""
+        return self._samples[:min(self.late_count, LATENESS_SAMPLES)]
+
+    def report(self):
+        """汇总本次演奏的调度延迟"""
+        count = self.late_count
+        if not count:
+            return "调度延迟：无事件"
+        ordered = sorted(self.lateness())
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        recent = f"，p99 为最近 {len(ordered)} 个" if count > len(ordered) else ""
+        return (f"调度延迟：平均 {self.late_total / count * 1000:.3f}ms，p99 {p99 * 1000:.3f}ms，"
+                f"最大 {self.late_max * 1000:.3f}ms（{count} 个事件{recent}）")
+
+
+# ==================== 按键计时记录 ====================
+TIMING_RING_SIZE = 1 << 16  # 最多保留最近多少个按键事件的计时
+TIMING_RECORD_FILE = "timing_record.csv"  # 命令行版演奏结束后导出的位置
+
+
+class TimingSummary(namedtuple("TimingSummary", [
+        "count", "dropped", "p50", "p99", "max", "send_mean", "bin_width", "histogram", "drift"])):
+    """
+    计时记录的汇总，时间单位为秒
+
+    p50 / p99 / max: 发送前时刻相对计划时间的延迟
+    send_mean: 平均每次发送（发送后 - 发送前）的耗时
+    histogram: 延迟分布，第 i 项为延迟落在 [i * bin_width, (i + 1) * bin_width) 的事件数，最后一项包含更大的延迟
+    drift: [(乐曲时间, 该时间段的平均延迟)]，看延迟是否随演奏时间增长
+    """
+    __slots__ = ()
+
+    def describe(self):
+        dropped = f"（较早的 {self.dropped} 个已覆盖）" if self.dropped else ""
+        return (f"按键计时：{self.count} 个事件{dropped}，发送延迟 p50 {self.p50 * 1000:.2f}ms，"
+                f"p99 {self.p99 * 1000:.2f}ms，最大 {self.max * 1000:.2f}ms，"
+                f"每次发送耗时 {self.send_mean * 1e6:.0f}us")
+
+
+class TimingRecorder:
+    """
+    按键计时记录（环形缓冲区）
+
+    每个按键事件记录计划时间、发送前和发送后的乐曲时间（秒）以及键码和按下标志。
+    缓冲区预先分配，演奏时只做数组赋值；写满后覆盖最早的记录。
+    """
+
+    def __init__(self, capacity=TIMING_RING_SIZE):
+        self.capacity = capacity
+        self.intended = array("d", bytes(8 * capacity))
+        self.before = array("d", bytes(8 * capacity))
+        self.after = array("d", bytes(8 * capacity))
+        self.vks = array("B", bytes(capacity))
+        self.downs = array("B", bytes(capacity))
+        self.count = 0  # 记录过的事件总数（含已被覆盖的）
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        """被覆盖的事件数"""
+        return max(0, self.count - self.capacity)
+
+    def record(self, intended, before, after, vk_codes, downs, start=0, stop=None):
+        """记录一次发送的 vk_codes[start:stop]，它们的计划时间和发送前后时刻相同"""
+        if stop is None:
+            stop = len(vk_codes)
+        capacity = self.capacity
+        count = self.count
+        for i in range(start, stop):
+            slot = count % capacity
+            self.intended[slot] = intended
+            self.before[slot] = before
+            self.after[slot] = after
+            self.vks[slot] = vk_codes[i]
+            self.downs[slot] = downs[i]
+            count += 1
+        self.count = count
+
+    def rows(self):
+        """按时间顺序返回 (计划时间, 发送前, 发送后, 键码, 是否按下)"""
+        first = self.count - len(self)
+        for n in range(first, self.count):
+            slot = n % self.capacity
+            yield (self.intended[slot], self.before[slot], self.after[slot],
+                   self.vks[slot], bool(self.downs[slot]))
+
+    def export_csv(self, path):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["intended", "before", "after", "vk", "down"])
+            for intended, before, after, vk_code, down in self.rows():
+                writer.writerow([f"{intended:.6f}", f"{before:.6f}", f"{after:.6f}", vk_code, int(down)])
+
+    def export_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"dropped": self.dropped,
+                       "columns": ["intended", "before", "after", "vk", "down"],
+                       "rows": list(self.rows())}, f)
+
+    def export(self, path):
+        """按扩展名导出为 .json 或 .csv"""
+        if path.lower().endswith(".json"):
+            self.export_json(path)
+        else:
+            self.export_csv(path)
+
+    def summary(self, bin_width=0.0005, bins=20, segments=40):
+        """汇总延迟分布和随时间的漂移，没有记录时返回 None"""
+        if not self.count:
+            return None
+        rows = list(self.rows())
+        lateness = [max(0.0, before - intended) for intended, before, _, _, _ in rows]
+        ordered = sorted(lateness)
+        count = len(ordered)
+
+        histogram = [0] * bins
+        for late in lateness:
+            histogram[min(bins - 1, int(late / bin_width))] += 1
+
+        # 按计划时间等分成若干段，每段取平均延迟
+        begin = rows[0][0]
+        span = max(rows[-1][0] - begin, 1e-9)
+        totals = [0.0] * segments
+        counts = [0] * segments
+        for (intended, _, _, _, _), late in zip(rows, lateness):
+            segment = min(segments - 1, int((intended - begin) / span * segments))
+            totals[segment] += late
+            counts[segment] += 1
+        drift = [(begin + span * (i + 0.5) / segments, totals[i] / counts[i])
+                 for i in range(segments) if counts[i]]
+
+        return TimingSummary(self.count, self.dropped,
+                             ordered[count // 2], ordered[min(count - 1, int(count * 0.99))], ordered[-1],
+                             sum(after - before for _, before, after, _, _ in rows) / count,
+                             bin_width, tuple(histogram), tuple(drift))
+
+
+def get_stop_deadline():
+    """获取停止演奏的期限（秒，线程安全）"""
+    with _configure_lock:
+        return max(1, configure.get("stop_deadline_ms", 50)) / 1000
+
+
 def print_split_line():
     print("_" * 50)
 
 
 # Windows键盘控制相关
 PUL = ctypes.POINTER(ctypes.c_ulong)
-SendInput = ctypes.windll.user32.SendInput
 
 
 class KeyBdInput(ctypes.Structure):
@@ -600,214 +1895,587 @@ class Input(ctypes.Structure):
                 ("ii", Input_I)]
 
 
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_SCANCODE = 0x0008
+
+
+# ==================== 按键输出后端 ====================
+class KeyOutputBackend:
+    """
+    按键输出后端接口
+
+    演奏线程和命令行演奏只通过 send / press / release 输出按键，
+    具体发给游戏、丢弃还是记录下来由后端决定，便于在非 Windows 环境下测量整个引擎。
+    """
+
+    def send(self, vk_codes, downs, start=0, stop=None):
+        """发送 vk_codes[start:stop]，downs[i] 为 True 表示按下，False 表示释放"""
+        raise NotImplementedError
+
+    def press(self, hex_key_code):
+        """按下单个键"""
+        self.send((hex_key_code,), (True,))
+
+    def release(self, hex_key_code):
+        """释放单个键"""
+        self.send((hex_key_code,), (False,))
+
+
+class SendInputBackend(KeyOutputBackend):
+    """
+    通过 SendInput 向游戏发送按键的后端
+
+    为 vk_lyre / vk_piano 中的每个键预先构造按下和释放两种 INPUT 结构，
+    并准备一个可复用的批量缓冲区。发送时只做索引查找和内存复制，
+    热路径上不再创建 ctypes 对象。
+    """
+
+    def __init__(self, send_input=None, batch_size=64):
+        if send_input is None:
+            send_input = ctypes.windll.user32.SendInput
+        self._send_input = send_input
+        self._size = ctypes.sizeof(Input)
+        self._extra = ctypes.c_ulong(0)
+
+        # 按键码 -> 预构造的 INPUT 结构（按下 / 释放）
+        codes = sorted(set(vk_lyre.values()) | set(vk_piano.values()))
+        self._pool = (Input * (len(codes) * 2))()
+        self._press_ref = {}
+        self._release_ref = {}
+        self._press_addr = {}
+        self._release_addr = {}
+        for i, hex_key_code in enumerate(codes):
+            for slot, flags, refs, addrs in ((i * 2, KEYEVENTF_SCANCODE, self._press_ref, self._press_addr),
+                                             (i * 2 + 1, KEYEVENTF_SCANCODE | KEYEVENTF_KEYUP,
+                                              self._release_ref, self._release_addr)):
+                self._pool[slot].type = 1
+                self._pool[slot].ii.ki = KeyBdInput(0, hex_key_code, flags, 0, ctypes.pointer(self._extra))
+                refs[hex_key_code] = ctypes.byref(self._pool, slot * self._size)
+                addrs[hex_key_code] = ctypes.addressof(self._pool) + slot * self._size
+
+        self._batch = None
+        self._batch_addr = []
+        self._resize_batch(batch_size)
+
+    def _resize_batch(self, batch_size):
+        self._batch = (Input * batch_size)()
+        base = ctypes.addressof(self._batch)
+        self._batch_addr = [base + i * self._size for i in range(batch_size)]
+
+    def press(self, hex_key_code):
+        """按下单个键"""
+        self._send_input(1, self._press_ref[hex_key_code], self._size)
+
+    def release(self, hex_key_code):
+        """释放单个键"""
+        self._send_input(1, self._release_ref[hex_key_code], self._size)
+
+    def send(self, vk_codes, downs, start=0, stop=None):
+        """把 vk_codes[start:stop] 复制进批量缓冲区，用一次 SendInput 发送"""
+        if stop is None:
+            stop = len(vk_codes)
+        count = stop - start
+        if count <= 0:
+            return
+        if count == 1:
+            refs = self._press_ref if downs[start] else self._release_ref
+            self._send_input(1, refs[vk_codes[start]], self._size)
+            return
+        if count > len(self._batch_addr):
+            self._resize_batch(count)
+        memmove = ctypes.memmove
+        size = self._size
+        batch_addr = self._batch_addr
+        press_addr = self._press_addr
+        release_addr = self._release_addr
+        for slot in range(count):
+            i = start + slot
+            memmove(batch_addr[slot], (press_addr if downs[i] else release_addr)[vk_codes[i]], size)
+        self._send_input(count, self._batch, size)
+
+
+class NullBackend(KeyOutputBackend):
+    """丢弃所有按键事件的后端，用于测量引擎本身的开销"""
+
+    def send(self, vk_codes, downs, start=0, stop=None):
+        pass
+
+    def press(self, hex_key_code):
+        pass
+
+    def release(self, hex_key_code):
+        pass
+
+
+class RecordingBackend(KeyOutputBackend):
+    """
+    记录按键事件的后端
+
+    每个事件的发送时间、键码和按下/释放标志写入预分配的数组，录满后丢弃并计数，
+    用于测量吞吐量和时间精度。
+    """
+
+    def __init__(self, capacity=1 << 18, clock=time.perf_counter):
+        self.capacity = capacity
+        self.clock = clock
+        self.times = array("d", bytes(8 * capacity))
+        self.vks = array("B", bytes(capacity))
+        self.downs = array("B", bytes(capacity))
+        self.count = 0
+        self.dropped = 0
+        self.send_calls = 0
+
+    def send(self, vk_codes, downs, start=0, stop=None):
+        if stop is None:
+            stop = len(vk_codes)
+        now = self.clock()
+        self.send_calls += 1
+        count = self.count
+        for i in range(start, stop):
+            if count >= self.capacity:
+                self.dropped += stop - i
+                break
+            self.times[count] = now
+            self.vks[count] = vk_codes[i]
+            self.downs[count] = downs[i]
+            count += 1
+        self.count = count
+
+    def clear(self):
+        """清空记录（不重新分配缓冲区）"""
+        self.count = 0
+        self.dropped = 0
+        self.send_calls = 0
+
+    def events(self):
+        """按顺序返回已记录的 (时间, 键码, 是否按下)"""
+        for i in range(self.count):
+            yield self.times[i], self.vks[i], bool(self.downs[i])
+
+
+_output_backend = None
+
+
+def set_output_backend(backend):
+    """设置全局按键输出后端"""
+    global _output_backend
+    _output_backend = backend
+
+
+def get_output_backend():
+    """获取全局按键输出后端（首次使用时创建，非 Windows 环境下为 NullBackend）"""
+    global _output_backend
+    if _output_backend is None:
+        _output_backend = SendInputBackend() if hasattr(ctypes, "windll") else NullBackend()
+    return _output_backend
+
+
+# ==================== 演奏会话 ====================
+class PlaybackConfig(namedtuple("PlaybackConfig", [
+        "auto_transpose", "lowest_pitch_name", "below_limit", "above_limit",
+        "black_keys", "spin_window", "stop_deadline", "timing_record", "quantizer", "limiter"])):
+    """
+    演奏用到的配置快照（不可变），spin_window 和 stop_deadline 单位为秒
+    quantizer 为按帧对齐用的 FrameQuantizer，frame_rate 为 0 时为 None
+    limiter 为编排用的 NoteLimiter，不限制按键数、也没有设置音轨权重时为 None
+    """
+    __slots__ = ()
+
+    @classmethod
+    def capture(cls):
+        """一次加锁读取全部配置"""
+        with _configure_lock:
+            fps = configure.get("frame_rate", 0)
+            limiter = NoteLimiter(max(0, configure.get("max_keys_per_instant", 0)),
+                                  max(0, configure.get("max_keys_per_second", 0)),
+                                  bool(configure.get("keep_melody", 1)),
+                                  bool(configure.get("keep_bass", 1)),
+                                  parse_track_weights(configure.get("track_weights", "")))
+            return cls(configure.get("auto_transpose", 1),
+                       configure.get("lowest_pitch_name", -1),
+                       configure.get("below_limit", 2),
+                       configure.get("above_limit", 2),
+                       (configure.get("black_key_1", 0),
+                        configure.get("black_key_2", 3),
+                        configure.get("black_key_3", 3)),
+                       max(0, configure.get("spin_window_ms", 2)) / 1000,
+                       max(1, configure.get("stop_deadline_ms", 50)) / 1000,
+                       bool(configure.get("timing_record", 0)),
+                       FrameQuantizer(fps, max(0, configure.get("min_down_frames", 1)),
+                                      max(0, configure.get("min_up_frames", 1))) if fps > 0 else None,
+                       limiter if any((limiter.max_keys_per_instant, limiter.max_keys_per_second,
+                                       limiter.track_weights)) else None)
+
+
+class PlaybackSession:
+    """
+    一次演奏的会话
+
+    instrument 和 config 是开始演奏时拿到的不可变快照，中途切换乐器或修改配置不影响本次演奏；
+    pressed 记录本会话按住的键，只由演奏所在的线程访问，因此热路径上不需要任何锁。
+    """
+
+    def __init__(self, backend=None, instrument=None, config=None):
+        self.instrument = instrument or get_instrument()
+        self.config = config or PlaybackConfig.capture()
+        self.backend = backend or get_output_backend()
+        self.pressed = set()
+
+    def note_table(self, base_note, from_key="C"):
+        """按会话的乐器和配置生成本曲的音符查找表"""
+        config = self.config
+        return build_note_table(self.instrument, base_note, from_key,
+                                config.below_limit, config.above_limit, config.black_keys)
+
+    def send(self, vk_codes, downs, start=0, stop=None):
+        """发送 vk_codes[start:stop] 并更新按住状态"""
+        if stop is None:
+            stop = len(vk_codes)
+        if stop <= start:
+            return
+        pressed = self.pressed
+        for i in range(start, stop):
+            if downs[i]:
+                pressed.add(vk_codes[i])
+            else:
+                pressed.discard(vk_codes[i])
+        self.backend.send(vk_codes, downs, start, stop)
+
+    def release_all(self):
+        """松开本会话按住的所有键"""
+        keys_to_release = list(self.pressed)
+        self.pressed.clear()
+        self.backend.send(keys_to_release, [False] * len(keys_to_release))
+
+    def release_every_key(self):
+        """
+        逐个松开本乐器的全部按键
+
+        不读取 pressed，也不使用后端的批量缓冲区，演奏线程没有响应时可以从其他线程调用。
+        """
+        for vk_code in sorted(set(self.instrument.vk.values())):
+            self.backend.release(vk_code)
+
+
 class PlayThread(QThread):
-    """演奏线程"""
+    """
+    演奏线程
+
+    演奏位置不通过信号逐事件发送，界面按显示帧率调用 position() 读取，
+    position() 直接由调度器的时钟算出，是唯一的位置来源。
+    pause() / resume() 在线程内暂停：冻结调度时钟、松开按键，恢复时从原来的事件继续，
+    不需要重新解析和编译乐曲。
+    每次演奏创建一个 PlaybackSession，乐器和配置在开始时取快照，演奏过程中不加锁。
+    stop_play() 是协作式的，不需要 terminate()：演奏线程在期限内松开所有按键并退出，
+    界面等待 finished 信号即可。
+    """
     playSignal = pyqtSignal(str)
-    progressSignal = pyqtSignal(float)  # 添加进度信号
+    lengthSignal = pyqtSignal(float)  # 加载乐曲后发送总时长（秒），界面不必自己解析文件
     file_path = None
     start_time = 0  # 添加起始时间属性
+    output_backend = None  # 按键输出后端，为空时使用全局后端
 
     def __init__(self, parent=None):
         super(PlayThread, self).__init__(parent)
         self.playFlag = False
         self._stop_event = threading.Event()  # 使用Event实现可中断等待
-        read_configure()
+        self._scheduler = None  # 正在演奏时的调度器
+        self._position = 0.0  # 不在演奏时的位置（秒）
+        self._paused = False
+        self._resume_event = threading.Event()
+        self._stop_requested_at = None  # 最近一次停止请求的时间
+        self._keys_released = True  # 演奏线程是否已在退出前松开所有按键
+        self._session = None  # 正在演奏的会话
+        self.last_stop_latency = None  # 最近一次从请求停止到松开所有按键的耗时（秒）
+        self.timing = None  # 开启 timing_record 时，最近一次演奏的 TimingRecorder
+
+    def position(self):
+        """当前演奏位置（秒），可在任意线程调用，不加锁"""
+        scheduler = self._scheduler
+        if scheduler is None:
+            return self._position
+        return max(self._position, scheduler.now())
+
+    def pause(self):
+        """暂停演奏（线程保持运行，等待 resume）"""
+        self._resume_event.clear()
+        self._paused = True
+        self._stop_event.set()  # 打断当前等待，由演奏线程处理暂停
+
+    def resume(self):
+        """从暂停处继续演奏"""
+        self._paused = False
+        self._resume_event.set()
+
+    def is_paused(self):
+        return self._paused
+
+    def start(self, priority=QThread.InheritPriority):
+        """开始演奏；启动线程前复位标志，start() 之后立刻 stop_play() 也不会丢失停止请求"""
+        self.playFlag = True
+        self._stop_event.clear()
+        self._stop_requested_at = None
+        self._keys_released = False
+        self._session = None  # run() 创建本次演奏的会话，不沿用上一次的
+        super(PlayThread, self).start(priority)
 
     def stop_play(self):
-        """协作式停止播放，确保资源正确释放"""
+        """
+        协作式停止播放，不阻塞调用线程
+
+        演奏线程被唤醒后松开所有按键并退出，耗时记录在 last_stop_latency。
+        线程在 stop_deadline_ms 内没有响应（例如正在解析很大的文件）时，由看门狗强制松开按键。
+        """
+        requested_at = time.perf_counter()
+        self._stop_requested_at = requested_at
         self.playFlag = False
         self._stop_event.set()  # 触发事件，中断等待
-        # 释放所有按下的键，防止按键卡住
-        release_all_keys()
+        self._resume_event.set()  # 暂停中也要醒来退出
+        session = self._session
+        if not self.isRunning() or session is None:  # 还没创建会话时不会有按键按下
+            return
+        # 期限取自会话开始时的配置快照，与 run() 报告停止耗时时使用的是同一个值
+        watchdog = threading.Timer(session.config.stop_deadline, self._stop_watchdog, args=(requested_at, session))
+        watchdog.daemon = True
+        watchdog.start()
+
+    def _stop_watchdog(self, requested_at, session):
+        if self._stop_requested_at == requested_at and not self._keys_released:
+            session.release_every_key()
+            print(f"演奏线程未在 {session.config.stop_deadline * 1000:.0f}ms 内停止，已强制松开所有按键")
 
     def set_file_path(self, file_path):
         self.file_path = file_path
     
+    def set_output_backend(self, backend):
+        self.output_backend = backend
+    
     def set_start_time(self, start_time):
         self.start_time = start_time
 
-    def _interruptible_sleep(self, seconds):
-        """可中断的睡眠，返回True表示正常完成，False表示被中断"""
-        if seconds <= 0:
-            return self.playFlag
-        # 使用Event.wait实现可中断等待
-        # wait返回True表示事件被set（即被中断），False表示超时
-        interrupted = self._stop_event.wait(timeout=seconds)
-        return not interrupted and self.playFlag
+    def _wait_until(self, scheduler, song_time, session):
+        """
+        等待到乐曲时间 song_time，期间处理暂停，返回 False 表示被停止
+        暂停时松开所有按键，恢复时立即重新按下暂停前按住的键
+        """
+        while not scheduler.wait_until(song_time):
+            # 先清除事件再检查标志，避免漏掉清除前刚到的停止请求
+            self._stop_event.clear()
+            if not self.playFlag:
+                return False
+            if self._paused and not self._hold_pause(scheduler, session):
+                return False
+        return True
+
+    def _hold_pause(self, scheduler, session):
+        """冻结调度时钟直到恢复，返回 False 表示暂停期间被停止"""
+        paused_at = scheduler.now()
+        self._position = max(self._position, paused_at)
+        self._scheduler = None
+        held_keys = sorted(session.pressed)
+        session.release_all()
+        print(f"已暂停于 {self._position:.2f} 秒")
+        while self._paused and self.playFlag:
+            self._resume_event.wait()
+        if not self.playFlag:
+            return False
+        scheduler.resume(paused_at)
+        self._scheduler = scheduler
+        session.send(held_keys, [True] * len(held_keys))
+        return True
 
     def run(self):
-        self.playFlag = True
-        self._stop_event.clear()  # 重置停止事件
+        self._position = self.start_time
+        self._paused = False
+        self.timing = None
+        # 窗口版在界面显示后才读取配置，这里兜底
+        ensure_configure()
+        session = PlaybackSession(self.output_backend)
+        self._session = session
+        profile_mark = profiler.mark()
+        try:
+            with profiler.span("演奏线程", start_time=self.start_time):
+                self._play(session)
+        finally:
+            # 无论正常结束还是被停止，都确保释放所有按键
+            session.release_all()
+            self._keys_released = True
+            self._scheduler = None
+            self._paused = False
+            if self._stop_requested_at is not None:
+                self.last_stop_latency = time.perf_counter() - self._stop_requested_at
+                deadline = session.config.stop_deadline
+                late = "，超出期限" if self.last_stop_latency > deadline else ""
+                print(f"停止耗时 {self.last_stop_latency * 1000:.2f}ms（期限 {deadline * 1000:.0f}ms{late}）")
+            if profiler.enabled:
+                print(profiler.report(profile_mark))
+                profiler.save()
+
+    def _play(self, session):
         global note_map
-        
-        midi = mido.MidiFile(self.file_path)
+        # 解析和分析结果有缓存，重复演奏和跳转不会重新解析
+        loaded = load_song(self.file_path)
+        if not self.playFlag:
+            return
+        analysis = loaded.analysis
+        self.lengthSignal.emit(analysis.length)
         print_split_line()
-        tracks = midi.tracks
         
-        # 检测调式（线程安全读取配置）
-        detected_key = "C"
-        with _configure_lock:
-            auto_transpose = configure.get("auto_transpose", 1)
-            lowest_pitch_name = configure["lowest_pitch_name"]
+        # 乐器和配置都来自会话开始时的快照，整首曲子保持不变
+        instrument = session.instrument
+        config = session.config
         
-        if auto_transpose == 1:
-            detected_key = detect_key_signature(tracks)
+        # 检测调式
+        detected_key = "C"
+        if config.auto_transpose == 1:
+            detected_key = analysis.detected_key
+            print(f"检测到的调式: {detected_key}")
             if detected_key != "C":
                 print(f"将从{detected_key}调自动转换到C调")
         
         # 获取基础音高
-        base_note = get_base_note(tracks) if lowest_pitch_name == -1 else lowest_pitch_name
+        with profiler.span("生成音符映射"):
+            base_note = choose_base_note(analysis, config.lowest_pitch_name)
+            note_table = session.note_table(base_note, detected_key)
         
         # 创建本次播放的音符映射（局部变量，整首曲子保持不变）
-        local_note_map = {note[i] + base_note * 12: key[i] for i in range(len(note))}
+        local_note_map = instrument.note_map(base_note)
         
         # 同时更新全局 note_map（供其他地方参考）
         with _note_map_lock:
             note_map = local_note_map.copy()
         
-        # 获取配置快照（整首曲子使用相同配置，不受中途配置变更影响）
-        with _configure_lock:
-            local_below_limit = configure.get("below_limit", 2)
-            local_above_limit = configure.get("above_limit", 2)
-        
-        # 预计算映射范围（整首曲子保持不变）
         local_note_map_keys = sorted(local_note_map.keys())
-        local_min_key = local_note_map_keys[0]
-        local_max_key = local_note_map_keys[-1]
-        
-        print(f"本次演奏音符映射范围: MIDI {local_min_key} - {local_max_key}")
+        print(f"本次演奏音符映射范围: MIDI {local_note_map_keys[0]} - {local_note_map_keys[-1]}")
         
-        # 使用可中断的等待
-        if not self._interruptible_sleep(1):
+        # 转调、折叠、黑键处理、键位查找全部在查找表中，预编译为演奏计划
+        # 如果设置了起始时间，直接跳到对应事件
+        held_keys, batches = playback_batches(loaded, note_table, self.start_time,
+                                              config.quantizer, config.limiter)
+        if not self.playFlag:
             self.playSignal.emit('停止演奏！')
             return
         
-        # 如果设置了起始时间，跳过前面的消息
-        elapsed_time = 0
-        messages_to_play = []
-        skip_time = self.start_time
-        
-        for msg in midi:
-            # 累加时间
-            if elapsed_time < skip_time:
-                elapsed_time += msg.time
-                if elapsed_time >= skip_time:
-                    # 调整第一个消息的时间
-                    adjusted_msg = msg.copy()
-                    adjusted_msg.time = elapsed_time - skip_time
-                    messages_to_play.append(adjusted_msg)
-                # 跳过这个消息
-            else:
-                messages_to_play.append(msg)
-        
-        # 如果没有设置起始时间，使用所有消息
-        if self.start_time == 0:
-            messages_to_play = list(midi)
-        
-        # 记录开始播放的时间
-        play_start_time = time.time() - self.start_time
-        
-        # 定义本地音符处理函数（使用本次播放的固定映射）
-        def process_note_local(n):
-            """处理音符，使用本次播放的固定映射"""
-            # 处理超出范围的音符 - 折叠到可演奏范围
-            while n < local_min_key and local_below_limit > 0:
-                n += 12
-                if local_below_limit == 1:
-                    break
-
-            while n > local_max_key and local_above_limit > 0:
-                n -= 12
-                if local_above_limit == 1:
-                    break
-            
-            return n
-        
-        # 播放消息
-        for msg in messages_to_play:
-            if not self.playFlag:
+        # 按绝对截止时间调度，不累积误差；开始前留 1 秒切换到游戏窗口（可暂停、可停止）
+        scheduler = DeadlineScheduler(self._stop_event, config.spin_window)
+        scheduler.start(self.start_time - 1)
+        self._scheduler = scheduler
+        with profiler.span("准备时间"):
+            if not self._wait_until(scheduler, self.start_time, session):
                 self.playSignal.emit('停止演奏！')
-                print('停止演奏！')
-                break
-            
-            # 使用可中断的等待替代 time.sleep
-            if msg.time > 0:
-                if not self._interruptible_sleep(msg.time):
+                return
+        # 还原此刻应按住的键
+        held_keys = sorted(held_keys)
+        session.send(held_keys, [True] * len(held_keys))
+        
+        # 播放事件，同一时刻的事件合并为一次 SendInput
+        send = session.send
+        timing = TimingRecorder() if config.timing_record else None
+        self.timing = timing
+        profiler.instant("开始发送按键")
+        with profiler.span("演奏"):
+            for event_time, vks, downs, start, stop in batches:
+                if not self.playFlag or not self._wait_until(scheduler, event_time, session):
                     self.playSignal.emit('停止演奏！')
                     print('停止演奏！')
                     break
-            
-            # 发送当前播放进度
-            current_play_time = time.time() - play_start_time
-            self.progressSignal.emit(current_play_time)
                 
-            if msg.type == "note_on" or msg.type == "note_off":
-                # 如果需要转调，先转换音符
-                original_note = msg.note
-                if auto_transpose == 1 and detected_key != "C":
-                    original_note = transpose_to_c(msg.note, detected_key)
-                
-                # 使用本地处理函数处理音符（保持整首曲子映射一致）
-                processed_note = process_note_local(original_note)
-                
-                # 检查音符是否在映射范围内
-                if processed_note not in local_note_map:
-                    continue
-                
-                target_key = local_note_map[processed_note]
-                
-                if not self.playFlag:
-                    self.playSignal.emit('停止演奏！！')
-                    print('停止演奏！！')
-                    break
-                    
-                if msg.type == "note_on":
-                    with _pressed_key_lock:
-                        key_pressed = vk[target_key] in pressed_key
-                    if key_pressed:
-                        release_key(vk[target_key])
-                    press_key(vk[target_key])
-                elif msg.type == "note_off":
-                    release_key(vk[target_key])
+                if timing is None:
+                    send(vks, downs, start, stop)
+                else:
+                    before = scheduler.now()
+                    send(vks, downs, start, stop)
+                    timing.record(event_time, before, scheduler.now(), vks, downs, start, stop)
         
-        # 播放结束后，确保释放所有按键
-        release_all_keys()
-
-
-def press_key(hex_key_code):
-    """按下指定键（线程安全）"""
-    global pressed_key
-    with _pressed_key_lock:
-        pressed_key.add(hex_key_code)
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput(0, hex_key_code, 0x0008, 0, ctypes.pointer(extra))
-    x = Input(ctypes.c_ulong(1), ii_)
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
-
-
-def release_key(hex_key_code):
-    """释放指定键（线程安全）"""
-    global pressed_key
-    with _pressed_key_lock:
-        pressed_key.discard(hex_key_code)
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput(0, hex_key_code, 0x0008 | 0x0002, 0, ctypes.pointer(extra))
-    x = Input(ctypes.c_ulong(1), ii_)
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
-
-
-def release_all_keys():
-    """释放所有当前按下的键，防止资源泄漏（线程安全）"""
-    global pressed_key
-    with _pressed_key_lock:
-        # 复制一份，避免在迭代时修改集合
-        keys_to_release = pressed_key.copy()
-    for hex_key_code in keys_to_release:
-        release_key(hex_key_code)
-    with _pressed_key_lock:
-        pressed_key.clear()
+        if self._scheduler is not None:  # 暂停中被停止时位置停在暂停处
+            self._position = scheduler.now()
+        print(scheduler.report())
+
+
+INDEX_STOP_POLL = 0.1  # 索引线程等待分析结果时，每隔多少秒检查一次停止请求
+
+
+class LibraryIndexer(QThread):
+    """
+    乐曲库后台索引线程
+
+    先从磁盘缓存读取，未命中的文件交给进程池并行分析，
+    每完成一首就通过 songIndexed 信号送回界面，不阻塞窗口。
+    stop_index() 后最多 INDEX_STOP_POLL 秒线程就会退出：还没开始的分析被取消，
+    不等待正在分析的文件（它们的结果直接丢弃）。
+    """
+    songIndexed = pyqtSignal(str, object)  # 文件名, SongInfo
+    indexFinished = pyqtSignal(int)  # 本次新分析的文件数
+
+    def __init__(self, parent=None, max_workers=None):
+        super(LibraryIndexer, self).__init__(parent)
+        self.midi_dir = DEFAULT_MIDI_DIR
+        self.file_names = []
+        self.prune = True
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._stop_event = threading.Event()
+
+    def set_files(self, midi_dir, file_names, prune=True):
+        """prune 为 True 表示 file_names 是整个曲库，索引后清理缓存中已不存在的文件"""
+        self.midi_dir = midi_dir
+        self.file_names = list(file_names)
+        self.prune = prune
+
+    def stop_index(self):
+        self._stop_event.set()
+
+    def run(self):
+        self._stop_event.clear()
+        cache = SongInfoCache()
+        paths = {}
+        pending = []
+        try:
+            for name in self.file_names:
+                if self._stop_event.is_set():
+                    return
+                path = os.path.join(self.midi_dir, name)
+                paths[path] = name
+                try:
+                    info = cache.get(path)
+                except OSError:
+                    continue
+                if info is None:
+                    pending.append(path)
+                else:
+                    self.songIndexed.emit(name, info)
+            if self.prune:
+                cache.prune(paths)
+
+            analyzed = 0
+            if len(pending) == 1:
+                info = cache.get_or_analyze(pending[0])
+                self.songIndexed.emit(paths[pending[0]], info)
+                analyzed = 1
+            elif pending:
+                pool = ProcessPoolExecutor(max_workers=min(self.max_workers, len(pending)))
+                try:
+                    futures = {pool.submit(analyze_file, path): path for path in pending}
+                    not_done = set(futures)
+                    while not_done and not self._stop_event.is_set():
+                        # 带超时等待，正在分析很大的文件时也能及时发现停止请求
+                        done, not_done = wait(not_done, timeout=INDEX_STOP_POLL, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            path = futures[future]
+                            try:
+                                info = future.result()
+                            except Exception as e:
+                                print(f"分析失败 {path}: {e}")
+                                continue
+                            cache.put(path, info)
+                            self.songIndexed.emit(paths[path], info)
+                            analyzed += 1
+                finally:
+                    stopping = self._stop_event.is_set()
+                    pool.shutdown(wait=not stopping, cancel_futures=stopping)
+            if not self._stop_event.is_set():
+                self.indexFinished.emit(analyzed)
+        finally:
+            cache.close()
 
 
 def is_admin():
@@ -823,6 +2491,7 @@ def main():
     print("世界线变动率：1.2.0.61745723")
     print("新功能：自动将其他调转换为C调")
     read_configure()
+    profiler.enable(configure.get("profile", 0))
     
     while True:
         try:
@@ -841,49 +2510,65 @@ def main():
             print("\n选择要打开的文件：")
             print("\n".join([str(i) + "、" + file_list[i] for i in range(len(file_list))]))
 
-            midi_file = mido.MidiFile(midi_dir + file_list[int(input("请输入文件前数字序号："))])
+            file_name = file_list[int(input("请输入文件前数字序号："))]
+            profile_mark = profiler.mark()
+            loaded = load_song(midi_dir + file_name)
             print_split_line()
-            tracks = midi_file.tracks
             
-            # 检测并显示调式（线程安全读取配置）
-            detected_key = "C"
-            with _configure_lock:
-                auto_transpose = configure.get("auto_transpose", 1)
-                lowest_pitch_name = configure["lowest_pitch_name"]
+            # 乐器和配置取快照，演奏过程中不再加锁
+            session = PlaybackSession()
+            config = session.config
             
-            if auto_transpose == 1:
-                detected_key = detect_key_signature(tracks)
+            # 检测并显示调式
+            detected_key = "C"
+            if config.auto_transpose == 1:
+                detected_key = loaded.analysis.detected_key
                 if detected_key != "C":
                     print(f"检测到{detected_key}调，将自动转换到C调演奏")
                 else:
                     print("检测到C调，无需转换")
             
-            base_note = get_base_note(tracks) if lowest_pitch_name == -1 else lowest_pitch_name
+            with profiler.span("生成音符映射"):
+                base_note = choose_base_note(loaded.analysis, config.lowest_pitch_name)
+                note_table = session.note_table(base_note, detected_key)
             with _note_map_lock:
-                note_map = {note[i] + base_note * 12: key[i] for i in range(len(note))}
+                note_map = session.instrument.note_map(base_note)
             
-            time.sleep(1)
+            # 与窗口版使用同一张查找表和同一套事件，输出完全一致
+            _, batches = playback_batches(loaded, note_table, quantizer=config.quantizer,
+                                          limiter=config.limiter)
             
-            for msg in midi_file.play():
-                if msg.type == "note_on" or msg.type == "note_off":
-                    # 转调处理
-                    original_note = msg.note
-                    if auto_transpose == 1 and detected_key != "C":
-                        original_note = transpose_to_c(msg.note, detected_key)
-                    
-                    note_list = get_note(original_note)
-                    with _note_map_lock:
-                        current_note_map = note_map.copy()
-                    for n in note_list:
-                        if n in current_note_map:
-                            if msg.type == "note_on":
-                                with _pressed_key_lock:
-                                    key_pressed = vk[current_note_map[n]] in pressed_key
-                                if key_pressed:
-                                    release_key(vk[current_note_map[n]])
-                                press_key(vk[current_note_map[n]])
-                            elif msg.type == "note_off":
-                                release_key(vk[current_note_map[n]])
+            with profiler.span("准备时间"):
+                time.sleep(1)
+            
+            # 按绝对截止时间调度，不累积误差；同一时刻的事件合并为一次 SendInput
+            scheduler = DeadlineScheduler(threading.Event(), config.spin_window)
+            timing = TimingRecorder() if config.timing_record else None
+            scheduler.start()
+            profiler.instant("开始发送按键")
+            try:
+                with profiler.span("演奏"):
+                    for event_time, vks, downs, start, stop in batches:
+                        scheduler.wait_until(event_time)
+                        if timing is None:
+                            session.send(vks, downs, start, stop)
+                        else:
+                            before = scheduler.now()
+                            session.send(vks, downs, start, stop)
+                            timing.record(event_time, before, scheduler.now(), vks, downs, start, stop)
+            finally:
+                # Ctrl+C 或演奏中出错时也要松开所有按键，不让游戏里的键一直按住
+                session.release_all()
+            
+            print(scheduler.report())
+            if profiler.enabled:
+                print(profiler.report(profile_mark))
+                profiler.save()
+                print(f"各阶段耗时已保存到 {PROFILE_TRACE_FILE}")
+            if timing is not None and timing.count:
+                print(timing.summary().describe())
+                timing.export_csv(TIMING_RECORD_FILE)
+                print(f"按键计时已导出到 {TIMING_RECORD_FILE}")
                                 
         except Exception as e:
             print("错误:" + str(e))
@@ -1,29 +1,26 @@
+import time
+# 尽早记录启动时间，--startup-profile 以此为起点
+STARTUP_BEGIN = time.perf_counter()
+
 import ctypes
+import multiprocessing
 import os
+import subprocess
 import sys
-import time
-import mido
-import qtawesome as qta
-
-# 修复 system_hotkey 与 pywin32 的兼容性问题
-import win32con
-if not hasattr(win32con, 'VK_MEDIA_STOP'):
-    win32con.VK_MEDIA_STOP = 0xB2
-if not hasattr(win32con, 'VK_MEDIA_PLAY_PAUSE'):
-    win32con.VK_MEDIA_PLAY_PAUSE = 0xB3
-if not hasattr(win32con, 'VK_MEDIA_PREV_TRACK'):
-    win32con.VK_MEDIA_PREV_TRACK = 0xB1
-if not hasattr(win32con, 'VK_MEDIA_NEXT_TRACK'):
-    win32con.VK_MEDIA_NEXT_TRACK = 0xB0
-
-from PyQt5.QtCore import QSize, Qt, QRect, pyqtSignal, QCoreApplication, QFileSystemWatcher, QTimer
-from PyQt5.QtGui import QKeySequence, QIcon, QFont, QFontDatabase
-from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QListWidget, QApplication, 
+import threading
+from collections import deque
+
+from PyQt5.QtCore import (QSize, Qt, QRect, QRectF, QPointF, pyqtSignal, QCoreApplication, QFileSystemWatcher,
+                          QTimer, QAbstractListModel, QModelIndex)
+from PyQt5.QtGui import QKeySequence, QIcon, QFont, QFontDatabase, QPainter, QColor, QPen, QPolygonF
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QListView, QApplication, 
+                             QAbstractItemView, 
                              QShortcut, QMessageBox, QLineEdit, QHBoxLayout, QSlider, 
-                             QPushButton, QFrame, QGraphicsDropShadowEffect, QComboBox)
-from system_hotkey import SystemHotkey, SystemRegisterError, InvalidKeyError, UnregisterError
+                             QPushButton, QFrame, QGraphicsDropShadowEffect, QComboBox, QFileDialog)
 
-from 疯物之诗琴 import PlayThread, is_admin, switch_instrument_mode, configure, save_configure
+from 疯物之诗琴 import (PlayThread, LibraryIndexer, is_admin, switch_instrument_mode, configure, read_configure,
+                   save_configure, get_midi_directory, get_stop_deadline, playable_ratio, note_density,
+                   note_name, profiler, PROFILE_TRACE_FILE)
 
 if hasattr(sys, 'frozen'):
     os.environ['PATH'] = sys._MEIPASS + ";" + os.environ['PATH']
@@ -38,16 +35,397 @@ def load_stylesheet():
     return ""
 
 
+def import_pypinyin():
+    """导入 pypinyin（需要几百毫秒，第一次建立搜索索引时再导入）"""
+    try:
+        import pypinyin
+    except ImportError:  # pypinyin 为可选依赖，没有时不支持拼音搜索
+        return None
+    return pypinyin
+
+
+def import_system_hotkey():
+    """导入 system_hotkey（较慢，界面显示后再导入）"""
+    # 修复 system_hotkey 与 pywin32 的兼容性问题
+    import win32con
+    if not hasattr(win32con, 'VK_MEDIA_STOP'):
+        win32con.VK_MEDIA_STOP = 0xB2
+    if not hasattr(win32con, 'VK_MEDIA_PLAY_PAUSE'):
+        win32con.VK_MEDIA_PLAY_PAUSE = 0xB3
+    if not hasattr(win32con, 'VK_MEDIA_PREV_TRACK'):
+        win32con.VK_MEDIA_PREV_TRACK = 0xB1
+    if not hasattr(win32con, 'VK_MEDIA_NEXT_TRACK'):
+        win32con.VK_MEDIA_NEXT_TRACK = 0xB0
+    import system_hotkey
+    return system_hotkey
+
+
+class StartupProfiler:
+    """
+    启动耗时统计（命令行参数 --startup-profile 开启）
+
+    记录各阶段距进程启动的时间，其中“首次绘制”即窗口第一次画出来，
+    “可交互”为配置、图标、热键和曲目列表都准备好的时刻。
+    结果打印到控制台并追加到 startup_profile.log（打包版没有控制台）。
+    """
+    LOG_FILE = 'startup_profile.log'
+
+    def __init__(self, enabled, begin=STARTUP_BEGIN):
+        self.enabled = enabled
+        self.begin = begin
+        self.marks = []  # (阶段, 距启动的秒数)
+
+    def mark(self, stage):
+        if self.enabled:
+            self.marks.append((stage, time.perf_counter() - self.begin))
+
+    def report(self):
+        if not self.enabled or not self.marks:
+            return
+        lines = ['启动耗时：']
+        last = 0.0
+        for stage, elapsed in self.marks:
+            lines.append(f'  {stage:<12}{elapsed * 1000:8.1f} ms  (+{(elapsed - last) * 1000:.1f} ms)')
+            last = elapsed
+        text = '\n'.join(lines)
+        print(text)
+        try:
+            with open(self.LOG_FILE, 'a', encoding='utf-8') as file:
+                file.write(time.strftime('%Y-%m-%d %H:%M:%S ') + text + '\n')
+        except OSError as e:
+            print(e)
+
+
+startup_profiler = StartupProfiler('--startup-profile' in sys.argv)
+
+
+def format_duration(seconds):
+    """秒数格式化为 mm:ss"""
+    minutes = int(seconds // 60)
+    secs = int(seconds % 60)
+    return f'{minutes:02d}:{secs:02d}'
+
+
+class TimingChart(QWidget):
+    """
+    按键计时图：左边是发送延迟的分布直方图，右边是延迟随乐曲时间的漂移
+
+    数据为 TimingRecorder.summary() 的结果，开启 timing_record 后每次演奏结束时更新。
+    """
+
+    def __init__(self, parent=None):
+        super(TimingChart, self).__init__(parent)
+        self.summary = None
+        self.setMinimumHeight(110)
+
+    def set_summary(self, summary):
+        self.summary = summary
+        self.update()
+
+    def paintEvent(self, event):
+        summary = self.summary
+        if summary is None:
+            return
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        half = self.width() // 2
+        label_height = 20
+        histogram_area = QRectF(8, label_height + 4, half - 16, self.height() - label_height - 12)
+        drift_area = QRectF(half + 8, label_height + 4, self.width() - half - 16, self.height() - label_height - 12)
+        peak = max(late for _, late in summary.drift) if summary.drift else 0.0
+
+        painter.setPen(QColor('#666666'))
+        painter.drawText(QRect(0, 0, half, label_height), Qt.AlignCenter,
+                         f'延迟分布（每格 {summary.bin_width * 1000:g}ms）')
+        painter.drawText(QRect(half, 0, self.width() - half, label_height), Qt.AlignCenter,
+                         f'延迟漂移（最高 {peak * 1000:.2f}ms）')
+        painter.setPen(QColor('#CCCCCC'))
+        for area in (histogram_area, drift_area):
+            painter.drawLine(area.bottomLeft(), area.bottomRight())
+
+        # 直方图，非空的格子至少画 1 像素高
+        top = max(summary.histogram) or 1
+        bar_width = histogram_area.width() / len(summary.histogram)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor('#4A90D9'))
+        for i, count in enumerate(summary.histogram):
+            if count:
+                bar_height = max(1.0, histogram_area.height() * count / top)
+                painter.drawRect(QRectF(histogram_area.left() + i * bar_width + 1,
+                                        histogram_area.bottom() - bar_height, max(1.0, bar_width - 2), bar_height))
+
+        # 漂移折线：横轴为乐曲时间，纵轴为该时间段的平均延迟
+        if len(summary.drift) > 1:
+            begin = summary.drift[0][0]
+            span = (summary.drift[-1][0] - begin) or 1.0
+            scale = peak or 1.0
+            points = QPolygonF([QPointF(drift_area.left() + drift_area.width() * (song_time - begin) / span,
+                                        drift_area.bottom() - drift_area.height() * late / scale)
+                                for song_time, late in summary.drift])
+            painter.setPen(QPen(QColor('#d9534f'), 2))
+            painter.drawPolyline(points)
+        painter.end()
+
+
+class SongSearchIndex:
+    """
+    曲目搜索索引
+
+    每首曲目的检索文本 = 文件名 + 拼音（全拼和首字母）+ 调式、时长等已索引信息，
+    预先建立 单字 / 双字 -> 曲目 的倒排表。查询时先用双字倒排表求交集得到子串匹配的候选，
+    结果太少时再用单字倒排表补充模糊（子序列）匹配，只对候选打分，曲库很大时每次按键也只需几毫秒。
+    计算拼音较慢（每首约 0.4ms），窗口在空闲时分批加入曲目，更新已有曲目的信息时沿用原来的拼音。
+    """
+
+    # 子串匹配结果少于这个数时才补充模糊匹配结果
+    FUZZY_THRESHOLD = 20
+
+    def __init__(self):
+        self._fields = {}  # 文件名 -> (文件名, 拼音, 信息)
+        self._postings = {}  # 单字或双字 -> 文件名集合
+        self._pypinyin = None  # 第一次加入曲目时导入
+
+    @staticmethod
+    def _grams(text):
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        grams.discard(' ')
+        return grams
+
+    def load_pinyin(self):
+        """导入 pypinyin（需要几百毫秒，可在后台线程调用）"""
+        if self._pypinyin is None:
+            self._pypinyin = import_pypinyin() or False
+
+    def _pinyin(self, title):
+        self.load_pinyin()
+        if not self._pypinyin:
+            return ''
+        lazy_pinyin = self._pypinyin.lazy_pinyin
+        full = ''.join(lazy_pinyin(title)).lower()
+        initials = ''.join(lazy_pinyin(title, style=self._pypinyin.Style.FIRST_LETTER)).lower()
+        return full + ' ' + initials
+
+    @staticmethod
+    def _info_text(info):
+        if info is None:
+            return ''
+        analysis = info.analysis
+        return f'{analysis.detected_key.lower()}调 {format_duration(analysis.length)}'
+
+    def add(self, name, info=None):
+        """加入或更新一首曲目"""
+        title = os.path.splitext(name)[0].lower()
+        old = self._fields.get(name)
+        pinyin = old[1] if old is not None and old[0] == title else self._pinyin(title)
+        if old is not None:
+            self.remove(name)
+        fields = (title, pinyin, self._info_text(info))
+        self._fields[name] = fields
+        for gram in self._grams(' '.join(fields)):
+            self._postings.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        fields = self._fields.pop(name, None)
+        if fields is None:
+            return
+        for gram in self._grams(' '.join(fields)):
+            names = self._postings.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._postings[gram]
+
+    def clear(self):
+        self._fields.clear()
+        self._postings.clear()
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    @staticmethod
+    def _substring_score(term, fields):
+        title, pinyin, info = fields
+        pos = title.find(term)
+        if pos >= 0:
+            return 1000 - pos - len(title) / 100  # 越靠前、标题越短越优先
+        pos = pinyin.find(term)
+        if pos >= 0:
+            return 800 - pos
+        if term in info:
+            return 600
+        return None
+
+    @staticmethod
+    def _fuzzy_score(term, fields):
+        # 按顺序出现即可，跨度越小得分越高
+        for text in fields[:2]:
+            start = text.find(term[0])
+            pos = start
+            if start < 0:
+                continue
+            for char in term[1:]:
+                pos = text.find(char, pos + 1)
+                if pos < 0:
+                    break
+            else:
+                return 400 - (pos - start)
+        return None
+
+    def _candidates(self, terms, gram_size):
+        """各关键词的 gram 倒排表求交集"""
+        candidates = None
+        for term in terms:
+            if gram_size == 2 and len(term) >= 2:
+                grams = {term[i:i + 2] for i in range(len(term) - 1)}
+            else:
+                grams = set(term)
+            postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+            term_candidates = set.intersection(*postings) if postings else set()
+            candidates = term_candidates if candidates is None else candidates & term_candidates
+            if not candidates:
+                return set()
+        return candidates
+
+    def _rank(self, terms, candidates, score):
+        ranked = []
+        for name in candidates:
+            fields = self._fields[name]
+            total = 0
+            for term in terms:
+                term_score = score(term, fields)
+                if term_score is None:
+                    break
+                total += term_score
+            else:
+                ranked.append((-total, name))
+        ranked.sort()
+        return [name for _, name in ranked]
+
+    def search(self, query):
+        """返回按相关度排序的文件名列表；多个关键词用空格分隔，需全部匹配"""
+        terms = query.lower().split()
+        if not terms:
+            return []
+        # 子串匹配：双字倒排表求交集，候选集很小
+        results = self._rank(terms, self._candidates(terms, 2), self._substring_score)
+        if len(results) < self.FUZZY_THRESHOLD:
+            # 结果太少时再做模糊匹配：每个字都必须出现，单字倒排表的交集就是候选集
+            matched = set(results)
+            fuzzy = self._candidates(terms, 1) - matched
+            results += self._rank(terms, fuzzy, lambda term, fields: (self._substring_score(term, fields)
+                                                                      or self._fuzzy_score(term, fields)))
+        return results
+
+
+class SongListModel(QAbstractListModel):
+    """
+    播放列表的数据模型（同时负责过滤）
+
+    只保存当前可见的文件名列表，过滤时整体替换列表而不是重建控件，
+    视图只会为屏幕上可见的几行取数据。
+    """
+
+    def __init__(self, describe, parent=None):
+        super(SongListModel, self).__init__(parent)
+        self._describe = describe  # SongInfo -> 提示文本
+        self.songInfo = {}  # 文件名 -> SongInfo
+        self.names = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name = self.names[index.row()]
+        if role == Qt.DisplayRole:
+            return name
+        if role == Qt.ToolTipRole:
+            info = self.songInfo.get(name)
+            return self._describe(info) if info else None
+        return None
+
+    def set_names(self, names):
+        self.beginResetModel()
+        self.names = list(names)
+        self.endResetModel()
+
+    def update_names(self, names):
+        """
+        只插入 / 删除有变化的行
+
+        视图的选中项和滚动位置不受影响。保留下来的曲目相对顺序变了时退回整体重置。
+        """
+        names = list(names)
+        new_set = set(names)
+        # 从后往前删除连续的已移除行
+        row = len(self.names) - 1
+        while row >= 0:
+            if self.names[row] in new_set:
+                row -= 1
+                continue
+            end = row
+            while row > 0 and self.names[row - 1] not in new_set:
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row, end)
+            del self.names[row:end + 1]
+            self.endRemoveRows()
+            row -= 1
+        kept = set(self.names)
+        if self.names != [name for name in names if name in kept]:
+            self.set_names(names)
+            return
+        # 从前往后插入连续的新增行
+        row = 0
+        while row < len(names):
+            if names[row] in kept:
+                row += 1
+                continue
+            end = row
+            while end + 1 < len(names) and names[end + 1] not in kept:
+                end += 1
+            self.beginInsertRows(QModelIndex(), row, end)
+            self.names[row:row] = names[row:end + 1]
+            self.endInsertRows()
+            row = end + 1
+
+    def name_at(self, row):
+        return self.names[row] if 0 <= row < len(self.names) else None
+
+
 class playWindow(QWidget):
     sig_hot_key = pyqtSignal(str)
+    sig_pinyin_loaded = pyqtSignal()
 
     def __init__(self, parent=None):
         super(playWindow, self).__init__(parent)
         # 创建自动演奏线程
         self.playThread = PlayThread()
+        # 创建乐曲库后台索引线程
+        self.libraryIndexer = LibraryIndexer()
+        self.libraryIndexer.songIndexed.connect(self.on_song_indexed)
+        self.libraryIndexer.finished.connect(self.on_library_index_finished)
         # 存储原始文件列表
         self.allFileList = []
-        self.fileList = []
+        # 播放列表模型（保存当前过滤后的曲目）和搜索索引
+        self.songModel = SongListModel(self.describe_song)
+        self.searchIndex = SongSearchIndex()
+        self.searchIndexReady = False  # 第一次搜索（或启动完成后空闲时）开始建立，全部加入后为 True
+        self.searchIndexPending = None  # 等待加入搜索索引的曲目，None 表示还没开始建立
+        # 在事件循环空闲时分批加入，每批不超过几毫秒，建立索引期间输入不卡顿
+        self.searchIndexTimer = QTimer()
+        self.searchIndexTimer.setInterval(0)
+        self.searchIndexTimer.timeout.connect(self.build_search_index_chunk)
+        self.sig_pinyin_loaded.connect(self.searchIndexTimer.start)
+        # 输入停顿后再搜索，避免每个按键都刷新列表
+        self.searchTimer = QTimer()
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(150)
+        self.searchTimer.timeout.connect(self.apply_search_filter)
         # 当前播放的文件和总时长
         self.current_midi_file = None
         self.total_duration = 0
@@ -55,12 +433,20 @@ class playWindow(QWidget):
         self.is_dragging = False
         self.is_paused = False  # 添加暂停状态
         self.pause_time = 0  # 记录暂停时的时间
-        # 创建文件系统监控器
+        self.pending_start = None  # 等上一次演奏线程退出后再开始的位置
+        # 创建文件系统监控器（界面显示后读取配置再开始监控）
         self.file_watcher = QFileSystemWatcher()
-        self.midi_path = "midi/"
-        if os.path.exists(self.midi_path):
-            self.file_watcher.addPath(self.midi_path)
-            self.file_watcher.directoryChanged.connect(self.on_directory_changed)
+        self.file_watcher.directoryChanged.connect(self.on_directory_changed)
+        self.midi_path = None
+        # 上一次扫描到的 文件名 -> (修改时间, 大小)，用于和新快照比较
+        self.dir_snapshot = {}
+        # 批量复制文件时会连续触发很多次变化，合并为一次处理
+        self.dirChangeTimer = QTimer()
+        self.dirChangeTimer.setSingleShot(True)
+        self.dirChangeTimer.setInterval(300)
+        self.dirChangeTimer.timeout.connect(self.sync_file_list)
+        # 等待加入后台索引的文件
+        self.index_queue = set()
         # 创建定时器更新进度
         self.progress_timer = QTimer()
         self.progress_timer.timeout.connect(self.update_progress)
@@ -68,23 +454,69 @@ class playWindow(QWidget):
         # ---------设置全局快捷键----------
         # 设置我们的自定义热键响应函数
         self.sig_hot_key.connect(self.mkey_press_event)
+        # 热键在界面显示后再注册（见 finish_startup）
+        self.hk_stop = None
+
+        # 5.设置pyqt5的快捷键，ESC退出工具（和关闭按钮一样经过 closeEvent）
+        QShortcut(QKeySequence("Escape"), self, self.close)
+        # Ctrl+Shift+P 开关演奏各阶段的耗时记录
+        QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.toggle_profiler)
+        # 6.设置图形界面
+        self.setup_ui()
+        self.first_painted = False
+        startup_profiler.mark('窗口创建')
+
+    # 第一次绘制完成后再做剩下的初始化，窗口先显示出来
+    def paintEvent(self, event):
+        super(playWindow, self).paintEvent(event)
+        if not self.first_painted:
+            self.first_painted = True
+            startup_profiler.mark('首次绘制')
+            QTimer.singleShot(0, self.finish_startup)
+
+    # 读取配置、加载图标、注册热键并扫描曲目
+    def finish_startup(self):
+        read_configure()
+        profiler.enable(configure.get("profile", 0))
+        self.modeComboBox.blockSignals(True)
+        self.modeComboBox.setCurrentIndex(configure.get("instrument_mode", 0))
+        self.modeComboBox.blockSignals(False)
+        startup_profiler.mark('读取配置')
+        self.load_icons()
+        startup_profiler.mark('加载图标')
+        self.register_hot_key()
+        startup_profiler.mark('注册热键')
+        self.midi_path = get_midi_directory()
+        if os.path.exists(self.midi_path):
+            self.file_watcher.addPath(self.midi_path)
+        self.reload_file_list()
+        startup_profiler.mark('可交互')
+        startup_profiler.report()
+        # 空闲时预先建立搜索索引（需要导入 pypinyin）
+        QTimer.singleShot(500, self.ensure_search_index)
+
+    def load_icons(self):
+        import qtawesome as qta
+        self.btnMin.setIcon(qta.icon('fa5s.minus', color='#5c5c5c'))
+        self.btnClose.setIcon(qta.icon('fa5s.times', color='#5c5c5c'))
+        self.searchLabel.setPixmap(qta.icon('fa5s.search', color='#4A90D9').pixmap(16, 16))
+        self.playPauseButton.setIcon(qta.icon('fa5s.play', color='white'))
+        self.stopButton.setIcon(qta.icon('fa5s.stop', color='white'))
+
+    def register_hot_key(self):
+        system_hotkey = import_system_hotkey()
         # 初始化热键
-        self.hk_stop = SystemHotkey()
+        self.hk_stop = system_hotkey.SystemHotkey()
         # 绑定快捷键和对应的信号发送函数
         try:
             self.hk_stop.register(('control', 'shift', 'g'), callback=lambda x: self.send_key_event("stop"))
-        except InvalidKeyError as e:
+        except system_hotkey.InvalidKeyError as e:
             QMessageBox(QMessageBox.Warning, '警告', '热键设置失败').exec_()
             print(e)
-        except SystemRegisterError as e:
+        except system_hotkey.SystemRegisterError as e:
             QMessageBox(QMessageBox.Warning, '警告', '热键设置冲突').exec_()
             print(e)
 
-        # 5.设置pyqt5的快捷键，ESC退出工具
-        QShortcut(QKeySequence("Escape"), self, self.stop_tool)
-        # 6.设置图形界面
-        self.setup_ui()
-
     def setup_custom_title_bar(self):
         self.titleBar = QWidget()
         self.titleBar.setObjectName("titleBar")
@@ -109,7 +541,6 @@ class playWindow(QWidget):
         # 最小化按钮
         self.btnMin = QPushButton()
         self.btnMin.setObjectName("btnMin")
-        self.btnMin.setIcon(qta.icon('fa5s.minus', color='#5c5c5c'))
         self.btnMin.setFixedSize(30, 30)
         self.btnMin.clicked.connect(self.showMinimized)
         layout.addWidget(self.btnMin)
@@ -117,7 +548,6 @@ class playWindow(QWidget):
         # 关闭按钮
         self.btnClose = QPushButton()
         self.btnClose.setObjectName("btnClose")
-        self.btnClose.setIcon(qta.icon('fa5s.times', color='#5c5c5c'))
         self.btnClose.setFixedSize(30, 30)
         self.btnClose.clicked.connect(self.close)
         layout.addWidget(self.btnClose)
@@ -174,7 +604,6 @@ class playWindow(QWidget):
         # 搜索框
         self.searchLayout = QHBoxLayout()
         self.searchLabel = QLabel()
-        self.searchLabel.setPixmap(qta.icon('fa5s.search', color='#4A90D9').pixmap(16, 16))
         self.searchInput = QLineEdit()
         self.searchInput.setPlaceholderText('搜索曲目...')
         self.searchInput.textChanged.connect(self.on_search_text_changed)
@@ -183,8 +612,10 @@ class playWindow(QWidget):
         self.searchLayout.addWidget(self.searchInput)
         
         # 播放列表
-        self.playList = QListWidget()
-        self.reload_file_list()
+        self.playList = QListView()
+        self.playList.setModel(self.songModel)
+        self.playList.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.playList.setUniformItemSizes(True)
         
         self.leftLayout.addLayout(self.searchLayout)
         self.leftLayout.addWidget(self.playList)
@@ -221,7 +652,6 @@ class playWindow(QWidget):
         self.modeComboBox = QComboBox()
         self.modeComboBox.addItem('🎻 诗琴模式 (21键，无黑键)')
         self.modeComboBox.addItem('🎹 钢琴模式 (36键，有黑键)')
-        self.modeComboBox.setCurrentIndex(configure.get("instrument_mode", 0))
         self.modeComboBox.setMinimumHeight(35)
         self.modeComboBox.setCursor(Qt.PointingHandCursor)
         self.modeComboBox.currentIndexChanged.connect(self.on_mode_changed)
@@ -234,14 +664,12 @@ class playWindow(QWidget):
         
         self.playPauseButton = QPushButton(' 播放')
         self.playPauseButton.setObjectName("playPauseButton")
-        self.playPauseButton.setIcon(qta.icon('fa5s.play', color='white'))
         self.playPauseButton.setIconSize(QSize(16, 16))
         self.playPauseButton.setMinimumHeight(45)
         self.playPauseButton.setCursor(Qt.PointingHandCursor)
         
         self.stopButton = QPushButton(' 停止')
         self.stopButton.setObjectName("stopButton")
-        self.stopButton.setIcon(qta.icon('fa5s.stop', color='white'))
         self.stopButton.setIconSize(QSize(16, 16))
         self.stopButton.setMinimumHeight(45)
         self.stopButton.setCursor(Qt.PointingHandCursor)
@@ -289,6 +717,13 @@ class playWindow(QWidget):
         self.playStatus.setMinimumHeight(40)
         self.playStatus.setWordWrap(True)
         
+        # 按键计时（开启 timing_record 后演奏结束时显示）
+        self.timingChart = TimingChart()
+        self.timingChart.hide()
+        self.timingExportButton = QPushButton('导出计时')
+        self.timingExportButton.clicked.connect(self.export_timing)
+        self.timingExportButton.hide()
+        
         # 添加到右侧布局
         self.rightLayout.addStretch()
         self.rightLayout.addWidget(self.titleLabel)
@@ -297,6 +732,8 @@ class playWindow(QWidget):
         self.rightLayout.addWidget(self.controlFrame)
         self.rightLayout.addStretch()
         self.rightLayout.addWidget(self.playStatus)
+        self.rightLayout.addWidget(self.timingChart)
+        self.rightLayout.addWidget(self.timingExportButton, 0, Qt.AlignRight)
         self.rightLayout.addStretch()
         
         # 添加到主布局
@@ -304,15 +741,21 @@ class playWindow(QWidget):
         self.mainLayout.addWidget(self.rightWidget, 6) # 右侧占 60%
         
         # 绑定操作函数
-        self.playList.itemClicked.connect(self.play_item_clicked)
+        self.playList.clicked.connect(self.play_item_clicked)
         self.playList.doubleClicked.connect(self.on_list_double_clicked)
         self.playThread.playSignal.connect(self.show_stop_play)
-        self.playThread.progressSignal.connect(self.on_play_progress)
+        self.playThread.lengthSignal.connect(self.set_total_duration)
+        self.playThread.finished.connect(self.on_play_thread_finished)
 
     # 在界面显示选择的状态
-    def play_item_clicked(self, item):
-        print('你选择了：' + item.text())
-        self.playStatus.setText('✨ 已选择：' + item.text())
+    def play_item_clicked(self, index):
+        name = self.songModel.name_at(index.row())
+        print('你选择了：' + name)
+        info = self.songModel.songInfo.get(name)
+        if info:
+            self.playStatus.setText('✨ 已选择：' + name + '\n' + self.describe_song(info))
+        else:
+            self.playStatus.setText('✨ 已选择：' + name)
 
     # 热键处理函数
     def mkey_press_event(self, i_str):
@@ -325,26 +768,26 @@ class playWindow(QWidget):
 
     # 双击列表项
     def on_list_double_clicked(self, index):
-        selected_file = self.fileList[index.row()]
-        self.current_midi_file = "midi/" + selected_file
+        selected_file = self.songModel.name_at(index.row())
+        self.current_midi_file = self.midi_path + selected_file
         self.is_paused = False
         self.pause_time = 0
         self.play_midi_from_position(0)
     
     # 播放/暂停按钮点击
     def on_play_pause_button_clicked(self):
-        if self.playThread.isRunning():
+        if self.playThread.isRunning() and not self.is_paused:
             # 当前正在播放，执行暂停
             self.pause_play()
+        elif self.is_paused and self.current_midi_file:
+            # 从暂停位置继续播放
+            self.resume_play()
         else:
             # 当前未播放，开始播放
-            if self.is_paused and self.current_midi_file:
-                # 从暂停位置继续播放
-                self.resume_play()
-            elif self.playList.currentRow() >= 0:
+            if self.playList.currentIndex().row() >= 0:
                 # 新开始播放
-                selected_file = self.fileList[self.playList.currentRow()]
-                self.current_midi_file = "midi/" + selected_file
+                selected_file = self.songModel.name_at(self.playList.currentIndex().row())
+                self.current_midi_file = self.midi_path + selected_file
                 self.is_paused = False
                 self.play_midi_from_position(0)
             else:
@@ -380,12 +823,12 @@ class playWindow(QWidget):
         else:
             self.msgLabel.setText('🎹 钢琴模式：36键含黑键\n支持完整半音阶演奏\n适合非C调曲目')
     
-    # 暂停播放
+    # 暂停播放：演奏线程冻结时钟并松开按键，但不退出
     def pause_play(self):
         if self.playThread.isRunning():
             self.is_paused = True
-            self.pause_time = self.current_time
-            self.stop_play_thread()
+            self.playThread.pause()
+            self.pause_time = self.playThread.position()
             self.playPauseButton.setText('▶ 继续')
             self.playStatus.setText('⏸️ 已暂停')
             # 停止进度更新
@@ -395,33 +838,34 @@ class playWindow(QWidget):
     def resume_play(self):
         if self.is_paused and self.current_midi_file:
             self.is_paused = False
-            self.play_midi_from_position(self.pause_time)
+            if self.playThread.isRunning() and self.playThread.playFlag:
+                # 线程仍在暂停中，直接从原来的事件继续
+                self.playThread.resume()
+                self.progress_timer.start()
+                self.playPauseButton.setText('⏸ 暂停')
+                self.playStatus.setText('🎵 演奏中：' + os.path.basename(self.current_midi_file))
+            else:
+                self.play_midi_from_position(self.pause_time)
     
     # 从指定位置播放
     def play_midi_from_position(self, start_time):
-        # 如果正在播放，先停止
+        # 如果正在播放，先停止，等线程退出（finished 信号）后再开始，不阻塞界面
         if self.playThread.isRunning():
+            self.pending_start = start_time
             self.playThread.stop_play()
             self.progress_timer.stop()
-            time.sleep(0.2)  # 等待线程完全停止
-            if not self.playThread.isFinished():
-                self.playThread.terminate()
-                self.playThread.wait()
+            return
         
         if not self.current_midi_file:
             return
             
-        # 获取MIDI文件总时长
-        try:
-            midi = mido.MidiFile(self.current_midi_file)
-            self.total_duration = midi.length
-            self.totalTimeLabel.setText(self.format_time(self.total_duration))
-            self.progressSlider.setMaximum(int(self.total_duration * 10))  # 0.1秒精度
-        except:
-            self.total_duration = 300  # 默认5分钟
-            
+        # 总时长取自后台索引的结果；还没索引到时由演奏线程加载乐曲后通知，界面线程不解析文件
+        info = self.songModel.songInfo.get(os.path.basename(self.current_midi_file))
+        self.set_total_duration(info.analysis.length if info is not None else None)
+
         file_name = os.path.basename(self.current_midi_file)
         print(f'开始演奏：{file_name}，从第{start_time:.1f}秒开始')
+        profiler.instant('请求演奏', file=file_name, start_time=start_time)
         
         # 显示演奏的状态
         if start_time > 0:
@@ -437,45 +881,85 @@ class playWindow(QWidget):
         self.progress_timer.start()
         self.playPauseButton.setText('⏸ 暂停')
 
+    # 设置总时长，None 表示还不知道（等演奏线程通知）
+    def set_total_duration(self, length):
+        self.total_duration = length
+        if length is None:
+            self.totalTimeLabel.setText('--:--')
+            return
+        self.totalTimeLabel.setText(self.format_time(length))
+        self.progressSlider.setMaximum(int(length * 10))  # 0.1秒精度
+
     def show_stop_play(self, msg):
         self.playStatus.setText('✅ ' + msg)
 
-    # 终止演奏线程，停止自动演奏
+    # 终止演奏线程，停止自动演奏（协作式停止，线程会在期限内松开按键并退出）
     def stop_play_thread(self):
         if not self.is_paused:  # 只有非暂停状态才显示停止
             self.playStatus.setText('⏹️ 已停止演奏')
+        self.pending_start = None
         self.playThread.stop_play()
         self.progress_timer.stop()  # 停止进度更新
         self.playPauseButton.setText('▶ 播放')
-        time.sleep(0.1)
-        if not self.playThread.isFinished():
-            self.playThread.terminate()
-            self.playThread.wait()
-        return
+    
+    # 演奏线程退出：开始等待中的演奏，或者恢复按钮状态
+    def on_play_thread_finished(self):
+        if self.pending_start is not None:
+            start_time, self.pending_start = self.pending_start, None
+            self.play_midi_from_position(start_time)
+            return
+        if not self.is_paused:
+            self.progress_timer.stop()
+            self.playPauseButton.setText('▶ 播放')
+        self.show_timing()
+    
+    # 开关各阶段耗时记录，关闭时保存还没保存的内容（每次演奏结束时已各自保存）
+    def toggle_profiler(self):
+        profiler.enable(not profiler.enabled)
+        if profiler.enabled:
+            self.playStatus.setText('⏱️ 已开启耗时记录，每次演奏结束后保存到 ' + PROFILE_TRACE_FILE)
+        elif profiler.save():
+            self.playStatus.setText('⏱️ 已关闭耗时记录，已保存到 ' + PROFILE_TRACE_FILE)
+        else:
+            self.playStatus.setText('⏱️ 已关闭耗时记录')
+    
+    # 显示最近一次演奏的按键计时（没有开启 timing_record 时隐藏）
+    def show_timing(self):
+        timing = self.playThread.timing
+        summary = timing.summary() if timing is not None else None
+        self.timingChart.set_summary(summary)
+        self.timingChart.setVisible(summary is not None)
+        self.timingExportButton.setVisible(summary is not None)
+        if summary is not None:
+            print(summary.describe())
+            self.timingChart.setToolTip(summary.describe())
+    
+    # 导出按键计时，按扩展名保存为 CSV 或 JSON
+    def export_timing(self):
+        timing = self.playThread.timing
+        if timing is None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, '导出按键计时', 'timing_record.csv',
+                                              'CSV (*.csv);;JSON (*.json)')
+        if path:
+            timing.export(path)
+            self.playStatus.setText('📊 按键计时已导出到 ' + path)
     
     # 格式化时间显示
     def format_time(self, seconds):
-        minutes = int(seconds // 60)
-        secs = int(seconds % 60)
-        return f'{minutes:02d}:{secs:02d}'
+        return format_duration(seconds)
     
-    # 更新播放进度
+    # 更新播放进度：定时读取演奏线程的位置
     def update_progress(self):
+        if self.total_duration is None:
+            return
         if not self.is_dragging and self.playThread.isRunning() and not self.is_paused:
-            self.current_time += 0.1
-            if self.current_time > self.total_duration:
-                self.current_time = self.total_duration
+            self.current_time = min(self.playThread.position(), self.total_duration)
+            if self.current_time >= self.total_duration:
                 self.on_stop_button_clicked()  # 播放完成，停止
             self.currentTimeLabel.setText(self.format_time(self.current_time))
             self.progressSlider.setValue(int(self.current_time * 10))
     
-    # 播放进度信号处理
-    def on_play_progress(self, current_time):
-        self.current_time = current_time
-        if not self.is_dragging:
-            self.currentTimeLabel.setText(self.format_time(current_time))
-            self.progressSlider.setValue(int(current_time * 10))
-    
     # 进度条按下
     def on_slider_pressed(self):
         self.is_dragging = True
@@ -486,7 +970,12 @@ class playWindow(QWidget):
         # 跳转到新位置播放
         new_time = self.progressSlider.value() / 10.0
         self.current_time = new_time
-        if self.playThread.isRunning():
+        if self.is_paused:
+            # 暂停时只记录新位置，继续播放时从这里开始
+            self.pause_time = new_time
+            if self.playThread.isRunning():
+                self.playThread.stop_play()
+        elif self.playThread.isRunning():
             self.play_midi_from_position(new_time)
     
     # 进度条移动
@@ -495,82 +984,222 @@ class playWindow(QWidget):
             time_pos = value / 10.0
             self.currentTimeLabel.setText(self.format_time(time_pos))
 
+    # 扫描midi文件夹，返回 文件名 -> (修改时间, 大小)
+    def scan_midi_directory(self):
+        snapshot = {}
+        with os.scandir(self.midi_path) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(('.mid', '.midi')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:  # 扫描过程中被删除
+                    continue
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
     # 重新加载文件列表
     def reload_file_list(self):
         try:
-            # 获取midi文件夹中的所有文件
-            all_files = os.listdir(self.midi_path)
-            # 只保留midi和mid文件
-            self.allFileList = [f for f in all_files if f.lower().endswith(('.mid', '.midi'))]
+            # 获取midi文件夹中的所有midi和mid文件
+            self.dir_snapshot = self.scan_midi_directory()
+            self.allFileList = list(self.dir_snapshot)
+            # 搜索索引等需要时再重建
+            self.searchIndexTimer.stop()
+            self.searchIndex.clear()
+            self.searchIndexReady = False
+            self.searchIndexPending = None
             # 应用当前的搜索过滤
             self.apply_search_filter()
+            # 后台索引时长、调式等信息
+            self.start_library_index(self.allFileList, full=True)
         except FileNotFoundError as e:
             QMessageBox(QMessageBox.Warning, '警告', '没有找到midi文件夹').exec_()
             print(e)
+            self.dir_snapshot = {}
             self.allFileList = []
-            self.fileList = []
+            self.songModel.set_names([])
     
-    # 文件夹变化时的处理函数
+    # 文件夹变化时的处理函数：等变化停止后再统一处理
     def on_directory_changed(self, path):
-        print(f'检测到文件夹变化: {path}')
-        # 保存当前正在播放的文件（如果有）
-        current_playing = None
-        if self.playThread.isRunning():
-            current_row = self.playList.currentRow()
-            if current_row >= 0 and current_row < len(self.fileList):
-                current_playing = self.fileList[current_row]
-        
-        # 重新加载文件列表
-        self.reload_file_list()
-        
-        # 如果之前有正在播放的文件，尝试重新选中它
-        if current_playing and current_playing in self.fileList:
-            index = self.fileList.index(current_playing)
-            self.playList.setCurrentRow(index)
+        self.dirChangeTimer.start()
+    
+    # 与上一次的快照比较，只处理新增、删除和修改过的文件
+    def sync_file_list(self):
+        try:
+            snapshot = self.scan_midi_directory()
+        except FileNotFoundError:
+            snapshot = {}
+        # 文件夹被删除后重建时监控会失效，需要重新加入
+        if os.path.exists(self.midi_path) and self.midi_path not in self.file_watcher.directories():
+            self.file_watcher.addPath(self.midi_path)
+        old = self.dir_snapshot
+        removed = [name for name in old if name not in snapshot]
+        changed = [name for name, stat in snapshot.items() if old.get(name) != stat]
+        if not removed and not changed:
+            return
+        print(f'检测到文件夹变化: 新增或修改 {len(changed)} 个，删除 {len(removed)} 个')
+        self.dir_snapshot = snapshot
+        self.allFileList = list(snapshot)
+        for name in removed:
+            self.songModel.songInfo.pop(name, None)
+            self.searchIndex.remove(name)
+            self.index_queue.discard(name)
+        for name in changed:
+            self.songModel.songInfo.pop(name, None)
+        self.queue_search_index(changed)
+        # 只插入 / 删除变化的行，选中项和滚动位置保持不变
+        self.songModel.update_names(self.filtered_file_list())
+        self.update_song_count()
+        if changed:
+            self.start_library_index(changed)
+    
+    # 选中指定曲目（不在当前列表中则忽略）
+    def select_song(self, name):
+        if name and name in self.songModel.names:
+            self.playList.setCurrentIndex(self.songModel.index(self.songModel.names.index(name)))
+    
+    # 当前搜索条件下的文件列表
+    def filtered_file_list(self):
+        search_text = self.searchInput.text().strip() if hasattr(self, 'searchInput') else ''
+        if search_text:
+            # 按相关度排序的搜索结果
+            self.ensure_search_index()
+            results = self.searchIndex.search(search_text)
+            if not self.searchIndexReady:
+                # 还没加入索引的曲目先只按文件名匹配，索引建立完成后再刷新
+                terms = search_text.lower().split()
+                results += [name for name in self.searchIndexPending
+                            if name not in self.searchIndex and all(term in name.lower() for term in terms)]
+            return results
+        # 如果搜索框为空，显示所有文件
+        return self.allFileList
+    
+    # 开始建立搜索索引：后台线程导入 pypinyin，导入后由定时器分批加入曲目
+    def ensure_search_index(self):
+        if self.searchIndexPending is not None:
+            return
+        self.searchIndexPending = deque(self.allFileList)
+        threading.Thread(target=self.load_pinyin, name='pinyin', daemon=True).start()
+
+    def load_pinyin(self):
+        self.searchIndex.load_pinyin()
+        self.sig_pinyin_loaded.emit()
+
+    # 新增或修改的曲目排队加入搜索索引（还没开始建立时等建立时一并加入）
+    def queue_search_index(self, names):
+        if self.searchIndexPending is None or not names:
+            return
+        self.searchIndexPending.extend(names)
+        if self.searchIndexReady:
+            self.searchIndexReady = False
+            self.searchIndexTimer.start()
+
+    # 加入一批曲目，超过时间预算就留到下一次定时器触发
+    def build_search_index_chunk(self):
+        pending = self.searchIndexPending
+        if pending is None:  # 导入 pypinyin 期间重新加载了文件列表
+            self.searchIndexTimer.stop()
+            return
+        deadline = time.perf_counter() + 0.004
+        while pending and time.perf_counter() < deadline:
+            name = pending.popleft()
+            if name in self.dir_snapshot:  # 排队期间被删除的文件不再加入
+                self.searchIndex.add(name, self.songModel.songInfo.get(name))
+        if pending:
+            return
+        self.searchIndexTimer.stop()
+        self.searchIndexReady = True
+        if self.searchInput.text().strip():
+            self.apply_search_filter()
     
     # 应用搜索过滤
     def apply_search_filter(self):
-        search_text = self.searchInput.text() if hasattr(self, 'searchInput') else ''
-        
-        if search_text:
-            # 过滤文件列表
-            self.fileList = [f for f in self.allFileList if search_text.lower() in f.lower()]
+        selected = self.songModel.name_at(self.playList.currentIndex().row())
+        # 只替换模型中的列表，不重建控件
+        self.songModel.set_names(self.filtered_file_list())
+        self.select_song(selected)
+        self.update_song_count()
+    
+    # 更新消息标签
+    def update_song_count(self):
+        if not hasattr(self, 'msgLabel'):
+            return
+        if self.searchInput.text().strip():
+            self.msgLabel.setText('🎹 双击列表选项开始演奏\nEsc 退出程序 | Ctrl+Shift+G 停止演奏\n🔍 搜索到 %d 条曲目（共 %d 条）' % (len(self.songModel.names), len(self.allFileList)))
         else:
-            # 如果搜索框为空，显示所有文件
-            self.fileList = self.allFileList.copy()
-        
-        # 更新列表显示
-        self.playList.clear()
-        self.playList.addItems(self.fileList)
-        
-        # 更新消息标签
-        if hasattr(self, 'msgLabel'):
-            if search_text:
-                self.msgLabel.setText('🎹 双击列表选项开始演奏\nEsc 退出程序 | Ctrl+Shift+G 停止演奏\n🔍 搜索到 %d 条曲目（共 %d 条）' % (len(self.fileList), len(self.allFileList)))
-            else:
-                self.msgLabel.setText('🎹 双击列表选项开始演奏\nEsc 退出程序 | Ctrl+Shift+G 停止演奏\n📂 共 %d 条曲目' % len(self.fileList))
+            self.msgLabel.setText('🎹 双击列表选项开始演奏\nEsc 退出程序 | Ctrl+Shift+G 停止演奏\n📂 共 %d 条曲目' % len(self.songModel.names))
+    
+    # 启动后台索引；正在索引时先排队，等本轮结束后再处理
+    def start_library_index(self, names, full=False):
+        if full:
+            self.index_queue.clear()
+        if self.libraryIndexer.isRunning():
+            self.index_queue.update(names)
+            return
+        self.libraryIndexer.set_files(self.midi_path, names, prune=full)
+        self.libraryIndexer.start()
+    
+    def on_library_index_finished(self):
+        if self.index_queue:
+            names = [name for name in self.index_queue if name in self.dir_snapshot]
+            self.index_queue.clear()
+            self.start_library_index(names)
+    
+    # 索引完成一首曲子
+    def on_song_indexed(self, name, info):
+        # 索引期间已被删除的文件直接忽略
+        if name not in self.dir_snapshot:
+            return
+        self.songModel.songInfo[name] = info
+        # 调式、时长也可以搜索（还没加入索引的曲目加入时会带上这些信息）
+        if name in self.searchIndex:
+            self.searchIndex.add(name, info)
+    
+    # 乐曲信息摘要
+    def describe_song(self, info):
+        analysis = info.analysis
+        parts = [format_duration(analysis.length), analysis.detected_key + '调']
+        if analysis.min_note <= analysis.max_note:
+            parts.append(f'{note_name(analysis.min_note)}-{note_name(analysis.max_note)}')
+        parts.append(f'可演奏 {playable_ratio(analysis):.0%}')
+        parts.append(f'{note_density(analysis):.1f} 音符/秒')
+        return ' | '.join(parts)
     
     # 搜索过滤功能
     def on_search_text_changed(self, text):
-        self.apply_search_filter()
+        self.searchTimer.start()
     
-    # 工具退出函数，主要用来停止演奏线程和退出注销热键
+    # 关闭窗口（关闭按钮、Esc、系统关闭）都在这里退出工具
+    def closeEvent(self, event):
+        self.stop_tool()
+        super(playWindow, self).closeEvent(event)
+
+    # 工具退出函数，主要用来停止演奏线程和索引线程、退出注销热键
     def stop_tool(self):
         self.stop_play_thread()
-        time.sleep(0.1)
+        self.index_queue.clear()  # 索引线程退出后不再开始下一轮
+        self.libraryIndexer.stop_index()
+        self.searchIndexTimer.stop()
+        # 退出前等演奏线程松开按键（最多等停止期限），再等索引线程取消剩下的分析并关闭缓存
+        self.playThread.wait(int(get_stop_deadline() * 1000))
+        self.libraryIndexer.wait()
         # 移除文件系统监控
         if self.file_watcher and self.midi_path:
             self.file_watcher.removePath(self.midi_path)
-        try:
-            self.hk_stop.unregister(('control', 'shift', 'g'))
-        except UnregisterError as e:
-            QMessageBox(QMessageBox.Warning, '警告', '热键注销失败').exec_()
-            print(e)
+        if self.hk_stop is not None:
+            from system_hotkey import UnregisterError
+            try:
+                self.hk_stop.unregister(('control', 'shift', 'g'))
+            except UnregisterError as e:
+                QMessageBox(QMessageBox.Warning, '警告', '热键注销失败').exec_()
+                print(e)
         QCoreApplication.instance().quit()
         print('退出了应用！！！')
 
 
 def main():
+    startup_profiler.mark('导入模块')
     app = QApplication(sys.argv)
     
     # 加载样式表
@@ -584,7 +1213,11 @@ def main():
 
 
 if __name__ == '__main__':
+    # 打包后的程序需要它来支持后台索引的进程池
+    multiprocessing.freeze_support()
     if is_admin():
         main()
     else:
-        ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, __file__, None, 1)
+        # 以管理员身份重新启动，保留 --startup-profile 等参数
+        params = subprocess.list2cmdline([__file__] + sys.argv[1:])
+        ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, params, None, 1)